@@ -1,8 +1,17 @@
-from flask import Flask, render_template, render_template_string, request, jsonify, redirect, url_for, send_file
+from flask import Flask, render_template, render_template_string, request, jsonify, redirect, url_for, send_file, g
 import requests
 import base64
 import os
+import csv
+import json
+import time
+import threading
+import uuid
+import logging
+import hmac
+import click
 import dotenv
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 from datetime import datetime
 from io import BytesIO
@@ -12,21 +21,68 @@ from reportlab.lib.units import inch
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+from billing_scheduler import BillingScheduler, INTERVAL_UNITS, connect as connect_billing_db
+from receipt_store import ReceiptStore
+from revenue_rollups import RollupStore, GRANULARITIES
+from velocity_checks import VelocityGuard, parse_rules
+from werkzeug.middleware.proxy_fix import ProxyFix
+from structured_logging import configure_logging, log_event, reset_log_context, bind_log_context, parse_sample_rates
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "secret-key")
+# Behind a load balancer remote_addr is the proxy, so trust that many X-Forwarded-For hops
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 
 PAYPAL_CLIENT_ID = os.environ.get("PAYPAL_CLIENT_ID") 
 PAYPAL_CLIENT_SECRET = os.environ.get("PAYPAL_CLIENT_SECRET")
 PAYPAL_API_BASE = os.environ.get("PAYPAL_API_BASE", "https://api-m.paypal.com")
+PAYPAL_POOL_SIZE = int(os.environ.get("PAYPAL_POOL_SIZE", "10"))
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN")
+BILLING_DB_PATH = os.environ.get("BILLING_DB_PATH", "billing.db")
+STATS_DB_PATH = os.environ.get("STATS_DB_PATH", "stats.db")
+RECEIPTS_DB_PATH = os.environ.get("RECEIPTS_DB_PATH", "receipts.db")
+VELOCITY_RULES = os.environ.get("VELOCITY_RULES", "ip=10/60,email=5/300,ip+amount=5/60")
+VELOCITY_STATE_PATH = os.environ.get("VELOCITY_STATE_PATH", os.path.join(app.instance_path, "velocity.bin"))
+# Checks per second the velocity sketches are sized for; memory grows linearly with it
+VELOCITY_PEAK_RATE = int(os.environ.get("VELOCITY_PEAK_RATE", "10000"))
 
-receipt_data_store = {}
+logger = configure_logging(
+    "checkout",
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    sample_rates=parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", "paypal.request=0.1")),
+    secrets=[PAYPAL_CLIENT_SECRET, ADMIN_API_TOKEN, app.secret_key]
+)
+
+receipt_data_store = ReceiptStore(RECEIPTS_DB_PATH)
+revenue_rollups = RollupStore(STATS_DB_PATH)
+os.makedirs(os.path.dirname(os.path.abspath(VELOCITY_STATE_PATH)), mode=0o700, exist_ok=True)
+velocity_guard = VelocityGuard(VELOCITY_STATE_PATH, parse_rules(VELOCITY_RULES), peak_rate=VELOCITY_PEAK_RATE)
+
+# One pooled session and one cached token shared by every request and worker thread
+paypal_session = requests.Session()
+paypal_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PAYPAL_POOL_SIZE))
+token_cache = {"access_token": None, "expires_at": 0}
+token_lock = threading.Lock()
+
+def paypal_post(call, url, **kwargs):
+    started = time.perf_counter()
+    response = paypal_session.post(url, **kwargs)
+    # Failures are logged as warnings so paypal.request sampling never drops them
+    level = logging.INFO if 200 <= response.status_code < 300 else logging.WARNING
+    log_event(logger, "paypal.request", level, call=call, status_code=response.status_code,
+              duration_ms=round((time.perf_counter() - started) * 1000, 1))
+    return response
 
 def get_access_token():
+    with token_lock:
+        if token_cache["access_token"] and time.time() < token_cache["expires_at"]:
+            return token_cache["access_token"]
+        return fetch_access_token()
+
+def fetch_access_token():
     url = f"{PAYPAL_API_BASE}/v1/oauth2/token"
-    print(f"Client ID: {PAYPAL_CLIENT_ID}")
-    print(f"Using API Base: {PAYPAL_API_BASE}")
-    
     credentials = f"{PAYPAL_CLIENT_ID}:{PAYPAL_CLIENT_SECRET}"
     encoded_credentials = base64.b64encode(credentials.encode()).decode()
     
@@ -36,10 +92,15 @@ def get_access_token():
     }
     
     data = {"grant_type": "client_credentials"}
-    response = requests.post(url, headers=headers, data=data)
+    response = paypal_post("oauth2.token", url, headers=headers, data=data)
     
     if response.status_code == 200:
-        return response.json()["access_token"]
+        token_data = response.json()
+        # Refresh a minute early so in-flight calls never carry an expired token
+        token_cache["access_token"] = token_data["access_token"]
+        token_cache["expires_at"] = time.time() + token_data.get("expires_in", 0) - 60
+        log_event(logger, "paypal.token_refreshed", api_base=PAYPAL_API_BASE, expires_in=token_data.get("expires_in"))
+        return token_data["access_token"]
     else:
         raise Exception(f"Failed to get access token: {response.text}")
 
@@ -72,7 +133,7 @@ def create_order(amount):
         }
     }
     
-    response = requests.post(url, json=payload, headers=headers)
+    response = paypal_post("orders.create", url, json=payload, headers=headers)
     
     if response.status_code == 201:
         order_data = response.json()
@@ -84,7 +145,7 @@ def create_order(amount):
     else:
         raise Exception(f"Failed to create order: {response.text}")
 
-def capture_order(order_id):
+def capture_order(order_id, idempotency_key=None):
     access_token = get_access_token()
     url = f"{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}/capture"
     
@@ -92,14 +153,268 @@ def capture_order(order_id):
         "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}"
     }
+    if idempotency_key:
+        headers["PayPal-Request-Id"] = idempotency_key
     
-    response = requests.post(url, headers=headers)
+    response = paypal_post("orders.capture", url, headers=headers)
     
     if response.status_code == 201:
         return response.json()
     else:
         raise Exception(f"Failed to capture order: {response.text}")
 
+def create_vaulted_order(amount, currency, vault_id, idempotency_key):
+    access_token = get_access_token()
+    url = f"{PAYPAL_API_BASE}/v2/checkout/orders"
+    
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+        "PayPal-Request-Id": idempotency_key
+    }
+    
+    # A saved payment method needs no buyer approval, so there are no return URLs
+    payload = {
+        "intent": "CAPTURE",
+        "purchase_units": [
+            {
+                "amount": {
+                    "currency_code": currency,
+                    "value": str(amount)
+                },
+                "description": "Subscription payment"
+            }
+        ],
+        "payment_source": {
+            "paypal": {
+                "vault_id": vault_id
+            }
+        }
+    }
+    
+    response = paypal_post("orders.create_vaulted", url, json=payload, headers=headers)
+    
+    if response.status_code in (200, 201):
+        return response.json()
+    else:
+        raise Exception(f"Failed to create order: {response.text}")
+
+def store_receipt(capture_data, order_id, payer_email=None):
+    capture = capture_data["purchase_units"][0]["payments"]["captures"][0]
+    payer = capture_data.get("payer", {})
+    name = payer.get("name", {})
+    transaction_id = capture["id"]
+    
+    receipt = {
+        'transaction_id': transaction_id,
+        'order_id': order_id,
+        'payer_name': f"{name.get('given_name', '')} {name.get('surname', '')}".strip(),
+        'payer_email': payer.get("email_address", payer_email),
+        'amount': capture["amount"]["value"],
+        'currency': capture["amount"]["currency_code"],
+        'status': capture_data["status"],
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    receipt_data_store[transaction_id] = receipt
+    record_rollup(receipt['date'], receipt['currency'], receipt['status'], receipt['amount'],
+                  f"capture:{transaction_id}")
+    return receipt
+
+def record_rollup(date, currency, status, amount, event_id=None):
+    # Dashboard totals must never fail a payment that PayPal already accepted
+    try:
+        revenue_rollups.record(date, currency, status, amount, event_id=event_id)
+    except Exception:
+        log_event(logger, "rollup.record_failed", logging.ERROR, date=date, currency=currency,
+                  status=status, amount=amount, exc_info=True)
+
+def charge_subscription(subscription, period, idempotency_key):
+    order = create_vaulted_order(subscription["amount"], subscription["currency"], subscription["vault_id"], idempotency_key)
+    # Vaulted orders usually complete on creation; capture any that stop at APPROVED
+    if order["status"] != "COMPLETED":
+        order = capture_order(order["id"], f"{idempotency_key}-capture")
+    
+    receipt = store_receipt(order, order["id"], subscription["payer_email"])
+    log_event(logger, "payment.captured", transaction_id=receipt['transaction_id'], amount=receipt['amount'],
+              currency=receipt['currency'], status=receipt['status'], subscription_id=subscription["id"], period=period)
+    return {"order_id": order["id"], "transaction_id": receipt['transaction_id']}
+
+def refund_capture(transaction_id, amount=None, currency="USD", idempotency_key=None):
+    access_token = get_access_token()
+    url = f"{PAYPAL_API_BASE}/v2/payments/captures/{transaction_id}/refund"
+    
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+        "PayPal-Request-Id": idempotency_key or f"refund-{uuid.uuid4().hex}",
+        "Prefer": "return=representation"
+    }
+    
+    # An empty body refunds the full captured amount
+    payload = {}
+    if amount is not None:
+        payload["amount"] = {"currency_code": currency, "value": str(amount)}
+    
+    response = paypal_post("captures.refund", url, json=payload, headers=headers)
+    
+    if response.status_code in (200, 201):
+        return response.json()
+    else:
+        raise Exception(f"Failed to refund capture: {response.text}")
+
+def void_authorization(authorization_id, idempotency_key=None):
+    access_token = get_access_token()
+    url = f"{PAYPAL_API_BASE}/v2/payments/authorizations/{authorization_id}/void"
+    
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+        "PayPal-Request-Id": idempotency_key or f"void-{authorization_id}"
+    }
+    
+    response = paypal_post("authorizations.void", url, headers=headers)
+    
+    if response.status_code in (200, 204):
+        return {"id": authorization_id, "status": "VOIDED"}
+    else:
+        raise Exception(f"Failed to void authorization: {response.text}")
+
+def refund_idempotency_key(transaction_id, amount=None):
+    return f"refund-{transaction_id}-{amount if amount is not None else 'full'}"
+
+def run_refund_job(job):
+    result = {
+        "idempotency_key": job["idempotency_key"],
+        "transaction_id": job["transaction_id"],
+        "action": job["action"],
+        "amount": job["amount"],
+    }
+    try:
+        if job["action"] == "void":
+            response = void_authorization(job["transaction_id"], job["idempotency_key"])
+        else:
+            response = refund_capture(job["transaction_id"], job["amount"], job["currency"], job["idempotency_key"])
+        result["status"] = response.get("status", "COMPLETED")
+        result["paypal_id"] = response.get("id")
+        refunded = response.get("amount", {})
+        result["refunded_amount"] = refunded.get("value", job["amount"])
+        result["currency"] = refunded.get("currency_code", job["currency"])
+    except Exception as e:
+        result["status"] = "FAILED"
+        result["error"] = str(e)
+        log_event(logger, "refund.failed", logging.ERROR, transaction_id=job["transaction_id"],
+                  action=job["action"], error=str(e))
+        return result
+    log_event(logger, "refund.completed", transaction_id=job["transaction_id"], action=job["action"],
+              amount=job["amount"], paypal_id=result["paypal_id"], status=result["status"])
+    return result
+
+def apply_refund_results(results):
+    # Receipts only carry data; PDFs are rebuilt from it on the next download
+    refund_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for result in results:
+        if result["status"] == "FAILED" or result["action"] != "refund":
+            continue
+        with receipt_data_store.edit(result["transaction_id"]) as receipt:
+            # PayPal answers a replayed PayPal-Request-Id with the original refund
+            if receipt is not None and result["paypal_id"] in receipt.get("refund_ids", []):
+                continue
+            refunded_amount = result["refunded_amount"]
+            if refunded_amount is None and receipt is not None:
+                refunded_amount = receipt["amount"]
+            if refunded_amount is not None:
+                # Keyed on the refund id, so a replay is counted once even without a receipt
+                record_rollup(refund_date, result["currency"], "REFUNDED", refunded_amount,
+                              f"refund:{result['paypal_id']}" if result["paypal_id"] else None)
+            if receipt is None:
+                continue
+            
+            total_refunded = Decimal(receipt.get("refunded_amount", "0")) + Decimal(refunded_amount)
+            receipt["refunded_amount"] = str(total_refunded)
+            receipt["refund_date"] = refund_date
+            receipt["refund_count"] = receipt.get("refund_count", 0) + 1
+            receipt["refund_id"] = result["paypal_id"]
+            receipt["refund_ids"] = receipt.get("refund_ids", []) + [result["paypal_id"]]
+            if total_refunded >= Decimal(receipt["amount"]):
+                receipt["status"] = "REFUNDED"
+            else:
+                receipt["status"] = "PARTIALLY_REFUNDED"
+
+def read_refund_file(path):
+    jobs = {}
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            row = [cell.strip() for cell in row]
+            if not row or not row[0] or row[0].startswith("#") or row[0] == "transaction_id":
+                continue
+            transaction_id = row[0]
+            amount = str(Decimal(row[1])) if len(row) > 1 and row[1] else None
+            action = row[2].lower() if len(row) > 2 and row[2] else "refund"
+            if action not in ("refund", "void"):
+                raise ValueError(f"Unknown action '{action}' for {transaction_id}")
+            currency = row[3].upper() if len(row) > 3 and row[3] else "USD"
+            if len(row) > 4 and row[4]:
+                idempotency_key = row[4]
+            elif action == "void":
+                idempotency_key = f"void-{transaction_id}"
+            else:
+                idempotency_key = refund_idempotency_key(transaction_id, amount)
+            # Identical rows share a key; running them concurrently would only race each other
+            jobs.setdefault(idempotency_key, {
+                "transaction_id": transaction_id,
+                "amount": amount,
+                "action": action,
+                "currency": currency,
+                "idempotency_key": idempotency_key,
+            })
+    return list(jobs.values())
+
+def load_refund_checkpoint(path):
+    completed = {}
+    if not os.path.exists(path):
+        return completed
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    for number, line in enumerate(lines, 1):
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # A run killed mid-write leaves a partial last line; that job simply runs again
+            if number == len(lines):
+                break
+            raise
+        if entry["status"] != "FAILED":
+            completed[entry["idempotency_key"]] = entry
+    return completed
+
+def process_bulk_refunds(jobs, checkpoint_path, workers=8, on_result=None):
+    completed = load_refund_checkpoint(checkpoint_path)
+    # A run killed between PayPal and the receipts would otherwise never update them.
+    # Re-applying is a no-op for refunds already recorded under their refund id.
+    apply_refund_results([entry for entry in completed.values() if entry.get("paypal_id")])
+    pending = [job for job in jobs if job["idempotency_key"] not in completed]
+    results = []
+    
+    with open(checkpoint_path, "a+") as checkpoint, ThreadPoolExecutor(max_workers=workers) as executor:
+        # Start on a fresh line if the previous run died halfway through one
+        if checkpoint.tell() > 0:
+            checkpoint.seek(checkpoint.tell() - 1)
+            if checkpoint.read(1) != "\n":
+                checkpoint.write("\n")
+        futures = [executor.submit(run_refund_job, job) for job in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            # Applied before the checkpoint line, so nothing marked done can be left unapplied
+            apply_refund_results([result])
+            # Written as each job finishes so an interrupted run resumes where it stopped
+            checkpoint.write(json.dumps(result) + "\n")
+            checkpoint.flush()
+            results.append(result)
+            if on_result:
+                on_result(result)
+    
+    return results, len(jobs) - len(pending)
+
 def generate_pdf_receipt(receipt_data):
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
@@ -212,6 +527,7 @@ def generate_pdf_receipt(receipt_data):
     elements.append(total_table)
     elements.append(Spacer(1, 0.3*inch))
     
+    status_color = colors.green if receipt_data['status'] == 'COMPLETED' else colors.red
     status_data = [['Payment Status:', receipt_data['status']]]
     status_table = Table(status_data, colWidths=[2*inch, 4*inch])
     status_table.setStyle(TableStyle([
@@ -219,7 +535,7 @@ def generate_pdf_receipt(receipt_data):
         ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
         ('FONTNAME', (1, 0), (1, -1), 'Helvetica-Bold'),
         ('FONTSIZE', (0, 0), (-1, -1), 11),
-        ('TEXTCOLOR', (1, 0), (1, -1), colors.green),
+        ('TEXTCOLOR', (1, 0), (1, -1), status_color),
         ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
     ]))
     elements.append(status_table)
@@ -240,6 +556,16 @@ def generate_pdf_receipt(receipt_data):
     buffer.seek(0)
     return buffer
 
+@app.before_request
+def assign_request_id():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    reset_log_context(request_id=g.request_id)
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = g.request_id
+    return response
+
 @app.route('/')
 def index():
     return render_template('payment.html')
@@ -251,36 +577,42 @@ def create_payment():
         amount = Decimal(amount)
         if amount <= 0:
             return "Amount must be greater than 0", 400
-        
+
+        rule = velocity_guard.check(
+            ip=request.remote_addr,
+            email=request.form.get('email', '').strip().lower(),
+            amount=str(amount.quantize(Decimal('0.01')))
+        )
+        if rule:
+            log_event(logger, "payment.velocity_rejected", logging.WARNING, rule=rule.dimension,
+                      limit=rule.limit, window=rule.window, ip=request.remote_addr, amount=str(amount))
+            return "Too many payment attempts. Please wait a minute and try again.", 429
+
         order_id, approval_url = create_order(amount)
+        log_event(logger, "payment.order_created", order_id=order_id, amount=str(amount))
         return redirect(approval_url)
         
-    except Exception as e:
-        return f"Error creating payment: {str(e)}", 500
+    except Exception:
+        log_event(logger, "payment.order_failed", logging.ERROR, exc_info=True)
+        return f"Error creating payment (reference {g.request_id})", 500
 
 @app.route('/payment/success')
 def payment_success():
     try:
         order_id = request.args.get('token')
+        bind_log_context(order_id=order_id)
         capture_data = capture_order(order_id)
         
-        status = capture_data["status"]
-        payer_email = capture_data["payer"]["email_address"]
-        payer_name = capture_data["payer"]["name"]["given_name"] + " " + capture_data["payer"]["name"]["surname"]
-        amount = capture_data["purchase_units"][0]["payments"]["captures"][0]["amount"]["value"]
-        currency = capture_data["purchase_units"][0]["payments"]["captures"][0]["amount"]["currency_code"]
-        transaction_id = capture_data["purchase_units"][0]["payments"]["captures"][0]["id"]
+        receipt = store_receipt(capture_data, order_id)
+        status = receipt['status']
+        payer_email = receipt['payer_email']
+        payer_name = receipt['payer_name']
+        amount = receipt['amount']
+        currency = receipt['currency']
+        transaction_id = receipt['transaction_id']
         
-        receipt_data_store[transaction_id] = {
-            'transaction_id': transaction_id,
-            'order_id': order_id,
-            'payer_name': payer_name,
-            'payer_email': payer_email,
-            'amount': amount,
-            'currency': currency,
-            'status': status,
-            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
+        log_event(logger, "payment.captured", transaction_id=transaction_id, amount=amount,
+                  currency=currency, status=status)
         
         html = f'''
         <!DOCTYPE html>
@@ -590,8 +922,9 @@ def payment_success():
         '''
         return render_template_string(html)
         
-    except Exception as e:
-        return f"Error processing payment: {str(e)}", 500
+    except Exception:
+        log_event(logger, "payment.capture_failed", logging.ERROR, exc_info=True)
+        return f"Error processing payment (reference {g.request_id})", 500
 
 @app.route('/download-receipt/<transaction_id>')
 def download_receipt(transaction_id):
@@ -608,8 +941,191 @@ def download_receipt(transaction_id):
             as_attachment=True,
             download_name=f'receipt_{transaction_id}.pdf'
         )
-    except Exception as e:
-        return f"Error generating receipt: {str(e)}", 500
+    except Exception:
+        log_event(logger, "receipt.render_failed", logging.ERROR, transaction_id=transaction_id, exc_info=True)
+        return f"Error generating receipt (reference {g.request_id})", 500
+
+def is_admin_request():
+    if not ADMIN_API_TOKEN:
+        return False
+    supplied = request.headers.get('Authorization', '').encode()
+    return hmac.compare_digest(supplied, f"Bearer {ADMIN_API_TOKEN}".encode())
+
+@app.route('/admin/refund/<transaction_id>', methods=['POST'])
+def refund_payment(transaction_id):
+    if not is_admin_request():
+        return "Unauthorized", 401
+    try:
+        if transaction_id not in receipt_data_store:
+            return "Receipt not found", 404
+        
+        receipt_data = receipt_data_store[transaction_id]
+        amount = request.form.get('amount')
+        if amount:
+            amount = Decimal(amount)
+            if amount <= 0:
+                return "Amount must be greater than 0", 400
+            amount = str(amount)
+        else:
+            amount = None
+        
+        # Only the caller can tell a retry from a second refund of the same amount
+        idempotency_key = request.headers.get('Idempotency-Key', '').strip()
+        if not idempotency_key or len(idempotency_key) > 100:
+            return "An Idempotency-Key header of up to 100 characters is required", 400
+        result = run_refund_job({
+            "transaction_id": transaction_id,
+            "amount": amount,
+            "action": "refund",
+            "currency": receipt_data['currency'],
+            "idempotency_key": idempotency_key,
+        })
+        if result["status"] == "FAILED":
+            return f"Error processing refund (reference {g.request_id})", 502
+        
+        apply_refund_results([result])
+        return jsonify({
+            'transaction_id': transaction_id,
+            'refund_id': result['paypal_id'],
+            'refund_status': result['status'],
+            'receipt_status': receipt_data_store[transaction_id]['status'],
+        })
+    except Exception:
+        log_event(logger, "refund.request_failed", logging.ERROR, transaction_id=transaction_id, exc_info=True)
+        return f"Error processing refund (reference {g.request_id})", 500
+
+@app.cli.command('bulk-refund')
+@click.argument('refund_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=8, show_default=True, help='Concurrent PayPal requests.')
+@click.option('--checkpoint', default=None, help='Progress file; defaults to REFUND_FILE.checkpoint.')
+def bulk_refund_command(refund_file, workers, checkpoint):
+    """Refund or void every transaction listed in REFUND_FILE.
+
+    Each CSV line is: transaction_id[,amount[,refund|void[,currency[,key]]]].
+    An empty amount refunds the full capture. Identical lines are run once;
+    give each line its own key to refund the same amount more than once. Safe to rerun: finished jobs
+    are skipped using the checkpoint file and PayPal idempotency keys.
+    Receipt statuses are updated in RECEIPTS_DB_PATH, the same store the
+    web app serves receipts from, so run it with the same setting.
+    """
+    jobs = read_refund_file(refund_file)
+    checkpoint = checkpoint or f"{refund_file}.checkpoint"
+    
+    def report(result):
+        detail = result.get("error") or result.get("paypal_id")
+        click.echo(f"{result['action']} {result['transaction_id']}: {result['status']} {detail}")
+    
+    results, skipped = process_bulk_refunds(jobs, checkpoint, workers=workers, on_result=report)
+    failed = sum(1 for result in results if result["status"] == "FAILED")
+    click.echo(f"Processed {len(results)}, skipped {skipped} already done, failed {failed}.")
+    if failed:
+        raise SystemExit(1)
+
+@app.route('/admin/stats')
+def revenue_stats():
+    if not is_admin_request():
+        return "Unauthorized", 401
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        return f"granularity must be one of {', '.join(GRANULARITIES)}", 400
+    
+    buckets = revenue_rollups.query(
+        granularity,
+        start=request.args.get('start'),
+        end=request.args.get('end'),
+        currency=request.args.get('currency'),
+        status=request.args.get('status')
+    )
+    
+    totals = {}
+    for bucket in buckets:
+        total = totals.setdefault(bucket['currency'], {}).setdefault(bucket['status'], {'count': 0, 'sum': Decimal('0')})
+        total['count'] += bucket['count']
+        total['sum'] += Decimal(bucket['sum'])
+    for by_status in totals.values():
+        for total in by_status.values():
+            total['average'] = str((total['sum'] / total['count']).quantize(Decimal('0.01')))
+            total['sum'] = str(total['sum'])
+    
+    return jsonify({'granularity': granularity, 'buckets': buckets, 'totals': totals})
+
+@app.cli.group('stats')
+def stats_cli():
+    """Maintain the revenue rollups behind /admin/stats."""
+
+@stats_cli.command('backfill')
+@click.argument('receipts_file', type=click.File('r'), required=False)
+def backfill_stats_command(receipts_file):
+    """Rebuild all rollups from the stored receipts.
+
+    Reads receipt_data_store by default. RECEIPTS_FILE ('-' for stdin) is a
+    JSON Lines file with one receipt per line, e.g. from another host.
+    Receipts are streamed once and the rollups are replaced in one
+    transaction.
+    """
+    if receipts_file is None:
+        receipts = receipt_data_store.values()
+    else:
+        receipts = (json.loads(line) for line in receipts_file if line.strip())
+    processed, rows = revenue_rollups.rebuild(receipts)
+    click.echo(f"Rebuilt {rows} rollup rows from {processed} receipts.")
+
+@app.cli.group('subscriptions')
+def subscriptions_cli():
+    """Manage recurring billing subscriptions."""
+
+@subscriptions_cli.command('add')
+@click.option('--email', required=True, help='Payer email address.')
+@click.option('--vault-id', required=True, help='PayPal vault ID of the saved payment method.')
+@click.option('--amount', required=True, help='Amount charged each period.')
+@click.option('--currency', default='USD', show_default=True)
+@click.option('--every', 'interval_unit', type=click.Choice(list(INTERVAL_UNITS)), default='month', show_default=True)
+@click.option('--count', 'interval_count', type=click.IntRange(min=1), default=1, show_default=True, help='Units between charges.')
+def add_subscription_command(email, vault_id, amount, currency, interval_unit, interval_count):
+    """Create a subscription whose first charge is due now."""
+    scheduler = BillingScheduler(connect_billing_db(BILLING_DB_PATH), charge_subscription)
+    subscription_id = scheduler.add_subscription(email, vault_id, amount, currency.upper(), interval_unit, interval_count)
+    click.echo(f"Created subscription {subscription_id}")
+
+@subscriptions_cli.command('cancel')
+@click.argument('subscription_id', type=int)
+def cancel_subscription_command(subscription_id):
+    """Stop billing a subscription."""
+    scheduler = BillingScheduler(connect_billing_db(BILLING_DB_PATH), charge_subscription)
+    scheduler.cancel_subscription(subscription_id)
+    click.echo(f"Cancelled subscription {subscription_id}")
+
+@subscriptions_cli.command('resume')
+@click.argument('subscription_id', type=int)
+def resume_subscription_command(subscription_id):
+    """Reactivate a PAST_DUE subscription; its unpaid period is retried on the next run."""
+    scheduler = BillingScheduler(connect_billing_db(BILLING_DB_PATH), charge_subscription)
+    if not scheduler.resume_subscription(subscription_id):
+        raise click.ClickException(f"Subscription {subscription_id} is not past due")
+    click.echo(f"Resumed subscription {subscription_id}")
+
+@subscriptions_cli.command('run')
+@click.option('--workers', default=8, show_default=True, help='Concurrent PayPal charges.')
+@click.option('--jitter', default=300, show_default=True, help='Seconds renewals are spread over.')
+@click.option('--max-catch-up', default=3, show_default=True, help='Missed periods billed after downtime.')
+@click.option('--once', is_flag=True, help='Charge what is due now and exit.')
+@click.option('--dry-run', is_flag=True, help='Print what is due without charging.')
+def run_subscriptions_command(workers, jitter, max_catch_up, once, dry_run):
+    """Charge due subscriptions, continuously unless --once or --dry-run."""
+    scheduler = BillingScheduler(connect_billing_db(BILLING_DB_PATH), charge_subscription, workers=workers,
+                                 jitter_seconds=jitter, max_catch_up=max_catch_up)
+    scheduler.load()
+    if not (once or dry_run):
+        scheduler.run_forever()
+    
+    for outcome in scheduler.run_due(dry_run=dry_run):
+        if dry_run:
+            click.echo(f"subscription {outcome['subscription_id']}: would charge periods {outcome['periods']}, "
+                       f"skip {outcome['skipped']}")
+            continue
+        for result in outcome["results"]:
+            detail = result["error"] or result["transaction_id"]
+            click.echo(f"subscription {outcome['subscription_id']} period {result['period']}: {result['status']} {detail}")
 
 @app.route('/payment/cancel')
 def payment_cancel():
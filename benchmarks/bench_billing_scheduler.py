@@ -0,0 +1,84 @@
+"""Dry-run benchmark of the recurring billing scheduler.
+
+Seeds a throwaway SQLite schedule with N monthly subscriptions, most of
+them anchored at the top of the same hour, then measures loading the heap,
+finding due charges, the dry-run plan and a full dispatch through the worker
+pool with a no-op charge in place of PayPal. It also reports how far jitter
+flattens the top-of-hour peak.
+
+    python benchmarks/bench_billing_scheduler.py --subscriptions 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from billing_scheduler import BillingScheduler, connect, jitter_offset
+
+
+def seed(conn, count, top_of_hour, jitter_seconds):
+    rng = random.Random(42)
+    now = time.time()
+    hour = now - now % 3600
+    rows = []
+    for subscription_id in range(1, count + 1):
+        anchor_at = hour if rng.random() < top_of_hour else hour - rng.uniform(0, 3600)
+        rows.append((subscription_id, f"payer{subscription_id}@example.com", f"VAULT{subscription_id}", "9.99",
+                     "USD", "month", 1, anchor_at, anchor_at + jitter_offset(subscription_id, jitter_seconds), now))
+    with conn:
+        conn.executemany(
+            "INSERT INTO subscriptions (id, payer_email, vault_id, amount, currency, interval_unit,"
+            " interval_count, anchor_at, next_run_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+    return hour
+
+
+def peak_per_second(conn, column):
+    counts = Counter(int(row[0]) for row in conn.execute(f"SELECT {column} FROM subscriptions"))
+    return max(counts.values())
+
+
+def timed(label, fn):
+    started = time.perf_counter()
+    result = fn()
+    print(f"{label:<32} {(time.perf_counter() - started) * 1000:9.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscriptions", type=int, default=100000)
+    parser.add_argument("--top-of-hour", type=float, default=0.8, help="Share anchored exactly on the hour.")
+    parser.add_argument("--jitter", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = connect(os.path.join(tmp, "bench.db"))
+        scheduler = BillingScheduler(conn, lambda subscription, period, key: {"order_id": key, "transaction_id": key},
+                                     workers=args.workers, jitter_seconds=args.jitter)
+
+        hour = timed(f"seed {args.subscriptions} rows", lambda: seed(conn, args.subscriptions, args.top_of_hour, args.jitter))
+        peak_without = peak_per_second(conn, "anchor_at")
+        peak_with = peak_per_second(conn, "next_run_at")
+        timed("load + heapify", scheduler.load)
+        timed("1000 x next_run_at", lambda: [scheduler.next_run_at() for _ in range(1000)])
+
+        now = hour + args.jitter
+        plan = timed("dry-run plan (all due)", lambda: scheduler.run_due(now, dry_run=True))
+        outcomes = timed("dispatch + record (no-op charge)", lambda: scheduler.run_due(now))
+        charged = sum(len(outcome["results"]) for outcome in outcomes)
+
+        print(f"{'due in dry run':<32} {len(plan):9d}")
+        print(f"{'charged':<32} {charged:9d}")
+        print(f"{'peak charges/s without jitter':<32} {peak_without:9d}")
+        print(f"{'peak charges/s with jitter':<32} {peak_with:9d}")
+
+
+if __name__ == "__main__":
+    main()
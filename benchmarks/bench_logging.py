@@ -0,0 +1,71 @@
+"""Measure how much structured logging adds to a request thread.
+
+Each simulated request emits the events a capture emits in app.py
+(three paypal.request calls, sampled, plus payment.captured). The numbers
+are the time spent in the caller only; the listener thread writes to
+/dev/null in the background.
+
+    python benchmarks/bench_logging.py --requests 20000
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from structured_logging import configure_logging, log_event, reset_log_context, shutdown_logging
+
+
+def simulate_request(logger, i):
+    reset_log_context(request_id=f"req-{i}")
+    for call in ("oauth2.token", "orders.capture", "captures.refund"):
+        log_event(logger, "paypal.request", call=call, status_code=201, duration_ms=12.5)
+    log_event(logger, "payment.captured", transaction_id=f"TX{i}", amount="10.00",
+              currency="USD", status="COMPLETED", authorization="Bearer abc123")
+
+
+def run(logger, requests):
+    timings = []
+    for i in range(requests):
+        started = time.perf_counter()
+        simulate_request(logger, i)
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+    return statistics.mean(timings), timings[int(len(timings) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--sample-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    disabled = logging.getLogger("bench.disabled")
+    disabled.setLevel(logging.CRITICAL)
+    disabled.propagate = False
+
+    with open(os.devnull, "w") as sink:
+        logger = configure_logging(
+            "bench.enabled", stream=sink,
+            sample_rates={"paypal.request": args.sample_rate},
+            queue_size=args.requests * 4
+        )
+        baseline = run(disabled, args.requests)
+        enabled = run(logger, args.requests)
+        started = time.perf_counter()
+        shutdown_logging(logger)
+        drain = time.perf_counter() - started
+
+    print(f"requests:              {args.requests}")
+    print(f"logging disabled:      mean {baseline[0]:.2f} us, p99 {baseline[1]:.2f} us per request")
+    print(f"logging enabled:       mean {enabled[0]:.2f} us, p99 {enabled[1]:.2f} us per request")
+    print(f"overhead:              {enabled[0] - baseline[0]:.2f} us per request")
+    print(f"dropped records:       {logger.queue_handler.dropped}")
+    print(f"background drain time: {drain * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Throughput and false rejects of the velocity check stage before create_order.
+
+Every check hashes an IP, an email and an amount and updates the rule
+sketches in the shared state file, the same work create_payment does.
+
+The accuracy pass replays legitimate traffic (every key new) at --rate
+checks per second on a simulated clock, for a bit more than the longest
+rule window. Any rejection there is a count-min overcount, and the run
+fails when the steady-state false reject rate is above
+--max-false-rejects. The throughput pass then runs --checks real-time
+checks in each of --processes processes to include lock contention
+between gunicorn workers.
+
+    python benchmarks/bench_velocity.py --rate 10000 --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from velocity_checks import VelocityGuard, parse_rules
+
+TARGET_PER_SECOND = 10000
+
+
+def legitimate_request(i):
+    # Distinct IP, email and amount per request, so no check should be rejected
+    return (f"{i >> 24 & 255}.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", f"payer{i}@example.com",
+            f"{(100 + i % 19900) / 100:.2f}")
+
+
+def run_accuracy(path, rules, rate):
+    guard = VelocityGuard(path, parse_rules(rules), peak_rate=rate)
+    window = max(rule.window for rule in guard.rules)
+    checks = int(rate * window * 1.1)
+    steady_from = int(rate * window)
+    rejected = steady_rejected = 0
+    started = time.perf_counter()
+    for i in range(checks):
+        ip, email, amount = legitimate_request(i)
+        if guard.check(i / rate, ip=ip, email=email, amount=amount):
+            rejected += 1
+            if i >= steady_from:
+                steady_rejected += 1
+    return checks, window, rejected, steady_rejected / (checks - steady_from), time.perf_counter() - started
+
+
+def run_checks(args):
+    path, rules, rate, checks, seed = args
+    guard = VelocityGuard(path, parse_rules(rules), peak_rate=rate)
+    requests = [legitimate_request((seed + 1) << 24 | i) for i in range(checks)]
+    timings = []
+    started = time.perf_counter()
+    for ip, email, amount in requests:
+        check_started = time.perf_counter()
+        guard.check(ip=ip, email=email, amount=amount)
+        timings.append(time.perf_counter() - check_started)
+    return time.perf_counter() - started, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", default="ip=10/60,email=5/300,ip+amount=5/60")
+    parser.add_argument("--rate", type=int, default=TARGET_PER_SECOND,
+                        help="Checks per second the sketches are sized for and the accuracy pass replays.")
+    parser.add_argument("--max-false-rejects", type=float, default=0.001,
+                        help="Fail when more than this fraction of new keys is rejected after one full window.")
+    parser.add_argument("--checks", type=int, default=100000, help="Real-time checks per process.")
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checks, window, rejected, steady_rate, elapsed = run_accuracy(
+            os.path.join(tmp, "accuracy.bin"), args.rules, args.rate)
+        print(f"accuracy:     {checks} new keys over {checks / args.rate:.0f} s simulated "
+              f"({window:.0f} s window) in {elapsed:.1f} s")
+        print(f"false reject: {rejected} total, {steady_rate:.4%} after one full window "
+              f"(limit {args.max_false_rejects:.4%})")
+
+        path = os.path.join(tmp, "velocity.bin")
+        state_size = VelocityGuard(path, parse_rules(args.rules), peak_rate=args.rate).size
+        jobs = [(path, args.rules, args.rate, args.checks, seed) for seed in range(args.processes)]
+        started = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(run_checks, jobs)
+        elapsed = time.perf_counter() - started
+
+    timings = sorted(t for _, process_timings in results for t in process_timings)
+    total = len(timings)
+    throughput = total / max(elapsed for elapsed, _ in results)
+    print(f"checks:       {total} across {args.processes} process(es) in {elapsed:.2f} s")
+    print(f"throughput:   {throughput:,.0f} checks/s (target {TARGET_PER_SECOND:,})")
+    print(f"latency:      p50 {timings[total // 2] * 1e6:.1f} us, p99 {timings[int(total * 0.99)] * 1e6:.1f} us")
+    print(f"state file:   {state_size / 1024 / 1024:.1f} MiB for {len(parse_rules(args.rules))} rules")
+    if steady_rate > args.max_false_rejects:
+        sys.exit(f"FAIL: false reject rate {steady_rate:.4%} is above {args.max_false_rejects:.4%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""Recurring billing on top of the PayPal order calls in app.py.
+
+Subscriptions live in a SQLite schedule table. The scheduler keeps a min-heap
+of (next_run_at, subscription_id), so finding the next due charge is
+O(log n) no matter how many subscriptions exist. Due charges go to a bounded
+thread pool. All database writes happen on the dispatching thread, one
+transaction per subscription as soon as its charges return.
+
+Every subscription runs at a fixed offset inside a jitter window. That
+spreads renewals anchored at the top of the hour over several minutes
+instead of firing them all at once. Completed charges are keyed by
+(subscription_id, period), so a repeated run never bills a recorded period
+again. A crash can only lose charges still in flight; those are retried with
+the same PayPal-Request-Id, which PayPal answers with the original order for
+as long as it keeps the key. Every attempt, including declines, is kept in
+subscription_attempts.
+"""
+import calendar
+import heapq
+import logging
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from structured_logging import log_event
+
+logger = logging.getLogger("checkout.billing")
+
+INTERVAL_UNITS = {"day": 86400, "week": 7 * 86400, "month": None}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id INTEGER PRIMARY KEY,
+    payer_email TEXT NOT NULL,
+    vault_id TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    currency TEXT NOT NULL DEFAULT 'USD',
+    interval_unit TEXT NOT NULL,
+    interval_count INTEGER NOT NULL DEFAULT 1,
+    anchor_at REAL NOT NULL,
+    next_period INTEGER NOT NULL DEFAULT 0,
+    next_run_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'ACTIVE',
+    failures INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subscriptions_due ON subscriptions (status, next_run_at);
+CREATE TABLE IF NOT EXISTS subscription_charges (
+    id INTEGER PRIMARY KEY,
+    subscription_id INTEGER NOT NULL REFERENCES subscriptions (id),
+    period INTEGER NOT NULL,
+    scheduled_for REAL NOT NULL,
+    status TEXT NOT NULL,
+    order_id TEXT,
+    transaction_id TEXT,
+    charged_at REAL NOT NULL,
+    UNIQUE (subscription_id, period)
+);
+CREATE TABLE IF NOT EXISTS subscription_attempts (
+    id INTEGER PRIMARY KEY,
+    subscription_id INTEGER NOT NULL REFERENCES subscriptions (id),
+    period INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    order_id TEXT,
+    transaction_id TEXT,
+    error TEXT,
+    attempted_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subscription_attempts_period ON subscription_attempts (subscription_id, period);
+"""
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode NORMAL still keeps every commit if the process crashes
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def add_months(dt, months):
+    month = dt.month - 1 + months
+    year = dt.year + month // 12
+    month = month % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+
+def period_start(anchor_at, unit, count, period):
+    # Always computed from the anchor, so month-end clamping never drifts
+    if unit == "month":
+        anchor = datetime.fromtimestamp(anchor_at, timezone.utc)
+        return add_months(anchor, period * count).timestamp()
+    return anchor_at + period * count * INTERVAL_UNITS[unit]
+
+
+def jitter_offset(subscription_id, jitter_seconds):
+    if jitter_seconds <= 0:
+        return 0.0
+    return zlib.crc32(str(subscription_id).encode()) % int(jitter_seconds * 1000) / 1000
+
+
+class BillingScheduler:
+    def __init__(self, conn, charge, workers=8, jitter_seconds=300, max_catch_up=3,
+                 max_failures=3, retry_delay=3600):
+        self.conn = conn
+        self.charge = charge
+        self.workers = workers
+        self.jitter_seconds = jitter_seconds
+        self.max_catch_up = max(1, max_catch_up)
+        self.max_failures = max_failures
+        self.retry_delay = retry_delay
+        self.heap = []
+        self.scheduled = {}
+
+    def run_time(self, subscription_id, anchor_at, unit, count, period):
+        return period_start(anchor_at, unit, count, period) + jitter_offset(subscription_id, self.jitter_seconds)
+
+    def add_subscription(self, payer_email, vault_id, amount, currency="USD", interval_unit="month",
+                         interval_count=1, anchor_at=None):
+        if interval_unit not in INTERVAL_UNITS:
+            raise ValueError(f"Unknown interval unit '{interval_unit}'")
+        if Decimal(amount) <= 0:
+            raise ValueError("Amount must be greater than 0")
+        # A zero or negative count never moves the period forward, so plan() would never finish
+        if int(interval_count) < 1:
+            raise ValueError("Interval count must be at least 1")
+        now = time.time()
+        anchor_at = now if anchor_at is None else anchor_at
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO subscriptions (payer_email, vault_id, amount, currency, interval_unit,"
+                " interval_count, anchor_at, next_run_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                (payer_email, vault_id, str(Decimal(amount)), currency, interval_unit, int(interval_count), anchor_at, now)
+            )
+            subscription_id = cursor.lastrowid
+            next_run_at = self.run_time(subscription_id, anchor_at, interval_unit, interval_count, 0)
+            self.conn.execute("UPDATE subscriptions SET next_run_at = ? WHERE id = ?", (next_run_at, subscription_id))
+        self.schedule(subscription_id, next_run_at)
+        return subscription_id
+
+    def cancel_subscription(self, subscription_id):
+        with self.conn:
+            self.conn.execute("UPDATE subscriptions SET status = 'CANCELLED' WHERE id = ?", (subscription_id,))
+        # The heap entry goes stale and is skipped when popped
+        self.scheduled.pop(subscription_id, None)
+
+    def resume_subscription(self, subscription_id, now=None):
+        """Reactivate a PAST_DUE subscription and retry its unpaid period right away.
+
+        Returns False when the subscription is not past due.
+        """
+        now = time.time() if now is None else now
+        with self.conn:
+            cursor = self.conn.execute(
+                "UPDATE subscriptions SET status = 'ACTIVE', failures = 0, next_run_at = ?"
+                " WHERE id = ? AND status = 'PAST_DUE'", (now, subscription_id)
+            )
+        if cursor.rowcount == 0:
+            return False
+        self.schedule(subscription_id, now)
+        return True
+
+    def schedule(self, subscription_id, next_run_at):
+        self.scheduled[subscription_id] = next_run_at
+        heapq.heappush(self.heap, (next_run_at, subscription_id))
+
+    def load(self):
+        rows = self.conn.execute("SELECT id, next_run_at FROM subscriptions WHERE status = 'ACTIVE'")
+        self.scheduled = {row["id"]: row["next_run_at"] for row in rows}
+        self.heap = [(next_run_at, subscription_id) for subscription_id, next_run_at in self.scheduled.items()]
+        heapq.heapify(self.heap)
+        return len(self.heap)
+
+    def next_run_at(self):
+        while self.heap and self.scheduled.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            next_run_at, subscription_id = heapq.heappop(self.heap)
+            if self.scheduled.get(subscription_id) == next_run_at:
+                del self.scheduled[subscription_id]
+                due.append(subscription_id)
+        return due
+
+    def plan(self, subscription, now):
+        """Return (periods to charge, periods skipped) for a due subscription.
+
+        Missed periods are caught up oldest first, but at most max_catch_up of
+        them; anything older is recorded as skipped instead of billed.
+        """
+        periods = []
+        period = subscription["next_period"]
+        while period_start(subscription["anchor_at"], subscription["interval_unit"],
+                           subscription["interval_count"], period) <= now:
+            periods.append(period)
+            period += 1
+        if not periods:
+            periods = [subscription["next_period"]]
+        return periods[-self.max_catch_up:], periods[:-self.max_catch_up]
+
+    def charge_periods(self, subscription, periods):
+        results = []
+        for period in periods:
+            idempotency_key = f"subscription-{subscription['id']}-{period}"
+            try:
+                charge = self.charge(subscription, period, idempotency_key)
+                results.append({"period": period, "status": "COMPLETED", "error": None, **charge})
+            except Exception as e:
+                results.append({"period": period, "status": "FAILED", "error": str(e),
+                                "order_id": None, "transaction_id": None})
+                # Later periods wait until this one succeeds
+                break
+        return results
+
+    def run_due(self, now=None, dry_run=False):
+        """Charge every subscription due at ``now`` and reschedule it.
+
+        With dry_run the plan is returned without calling PayPal or touching
+        the database.
+        """
+        now = time.time() if now is None else now
+        due_ids = self.pop_due(now)
+        if not due_ids:
+            return []
+
+        subscriptions = {}
+        for start in range(0, len(due_ids), 500):
+            chunk = due_ids[start:start + 500]
+            # Filtering status in SQL makes SQLite scan the status index instead of using the primary key
+            rows = self.conn.execute(f"SELECT * FROM subscriptions WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            subscriptions.update((row["id"], dict(row)) for row in rows if row["status"] == "ACTIVE")
+
+        jobs = [(subscription, *self.plan(subscription, now)) for subscription in subscriptions.values()]
+        if dry_run:
+            for subscription, periods, skipped in jobs:
+                self.schedule(subscription["id"], subscription["next_run_at"])
+            return [{"subscription_id": s["id"], "periods": periods, "skipped": skipped} for s, periods, skipped in jobs]
+
+        outcomes = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.charge_periods, subscription, periods): (subscription, skipped)
+                       for subscription, periods, skipped in jobs}
+            # Saved as each subscription finishes, so a crash cannot forget charges already made
+            for future in as_completed(futures):
+                subscription, skipped = futures[future]
+                outcomes[subscription["id"]] = results = future.result()
+                self.save(*self.record(subscription, skipped, results, now))
+        return [{"subscription_id": s["id"], "results": outcomes[s["id"]], "skipped": skipped}
+                for s, _, skipped in jobs]
+
+    def save(self, charges, attempts, update):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO subscription_charges (subscription_id, period, scheduled_for, status,"
+                " order_id, transaction_id, charged_at) VALUES (?, ?, ?, ?, ?, ?, ?)", charges
+            )
+            self.conn.executemany(
+                "INSERT INTO subscription_attempts (subscription_id, period, status, order_id, transaction_id,"
+                " error, attempted_at) VALUES (?, ?, ?, ?, ?, ?, ?)", attempts
+            )
+            self.conn.execute(
+                "UPDATE subscriptions SET next_period = ?, next_run_at = ?, failures = ?, status = ? WHERE id = ?",
+                update
+            )
+        next_period, next_run_at, failures, status, subscription_id = update
+        if status == "ACTIVE":
+            self.schedule(subscription_id, next_run_at)
+
+    def record(self, subscription, skipped, results, now):
+        """Return the charge rows, attempt rows and schedule update for one dispatched subscription."""
+        subscription_id = subscription["id"]
+        unit, count, anchor_at = subscription["interval_unit"], subscription["interval_count"], subscription["anchor_at"]
+        charges = [(subscription_id, period, period_start(anchor_at, unit, count, period), "SKIPPED", None, None, now)
+                   for period in skipped]
+        charges += [(subscription_id, result["period"], period_start(anchor_at, unit, count, result["period"]),
+                     result["status"], result["order_id"], result["transaction_id"], now)
+                    for result in results if result["status"] == "COMPLETED"]
+        attempts = [(subscription_id, result["period"], result["status"], result["order_id"],
+                     result["transaction_id"], result["error"], now) for result in results]
+
+        completed = [result["period"] for result in results if result["status"] == "COMPLETED"]
+        next_period = completed[-1] + 1 if completed else (skipped[-1] + 1 if skipped else subscription["next_period"])
+        failed = next((result for result in results if result["status"] == "FAILED"), None)
+
+        if failed is None:
+            failures = 0
+            status = "ACTIVE"
+            next_run_at = self.run_time(subscription_id, anchor_at, unit, count, next_period)
+        else:
+            failures = subscription["failures"] + 1
+            status = "PAST_DUE" if failures >= self.max_failures else "ACTIVE"
+            next_run_at = now + self.retry_delay
+            log_event(logger, "subscription.charge_failed", logging.WARNING, subscription_id=subscription_id,
+                      period=failed["period"], failures=failures, error=failed["error"])
+        return charges, attempts, (next_period, next_run_at, failures, status, subscription_id)
+
+    def run_forever(self, poll_interval=30, reload_interval=300):
+        # Periodic reloads pick up subscriptions added by other processes
+        reloaded_at = 0
+        while True:
+            if time.time() - reloaded_at >= reload_interval:
+                self.load()
+                reloaded_at = time.time()
+            self.run_due()
+            next_run_at = self.next_run_at()
+            wait = poll_interval if next_run_at is None else min(poll_interval, next_run_at - time.time())
+            time.sleep(max(wait, 0.05))
@@ -0,0 +1,93 @@
+"""Receipts shared by the web app and the CLI commands.
+
+The web app, `flask bulk-refund` and `flask subscriptions run` are separate
+processes, so receipts live in SQLite instead of a module-level dict. The
+store behaves like the dict it replaced. Code that changes a stored receipt
+goes through ``edit`` so that concurrent writers do not overwrite each
+other.
+"""
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    transaction_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+
+class ReceiptStore(MutableMapping):
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+
+    def connection(self):
+        # SQLite connections cannot be shared across threads, so each worker gets its own
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def __getitem__(self, transaction_id):
+        row = self.connection().execute(
+            "SELECT data FROM receipts WHERE transaction_id = ?", (transaction_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(transaction_id)
+        return json.loads(row[0])
+
+    def __setitem__(self, transaction_id, receipt):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO receipts (transaction_id, data) VALUES (?, ?)",
+            (transaction_id, json.dumps(receipt))
+        )
+
+    def __delitem__(self, transaction_id):
+        cursor = self.connection().execute("DELETE FROM receipts WHERE transaction_id = ?", (transaction_id,))
+        if cursor.rowcount == 0:
+            raise KeyError(transaction_id)
+
+    def __contains__(self, transaction_id):
+        return self.connection().execute(
+            "SELECT 1 FROM receipts WHERE transaction_id = ?", (transaction_id,)
+        ).fetchone() is not None
+
+    def __iter__(self):
+        for (transaction_id,) in self.connection().execute("SELECT transaction_id FROM receipts"):
+            yield transaction_id
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+
+    def values(self):
+        # One streaming cursor instead of a lookup per key
+        for (data,) in self.connection().execute("SELECT data FROM receipts ORDER BY rowid"):
+            yield json.loads(data)
+
+    @contextmanager
+    def edit(self, transaction_id):
+        """Yield the stored receipt (or None) and save changes made to it.
+
+        The write lock is taken before reading, so a refund applied by the
+        bulk CLI cannot lose an update made by the web app at the same time.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM receipts WHERE transaction_id = ?", (transaction_id,)).fetchone()
+            receipt = json.loads(row[0]) if row else None
+            yield receipt
+            if receipt is not None:
+                conn.execute("UPDATE receipts SET data = ? WHERE transaction_id = ?",
+                             (json.dumps(receipt), transaction_id))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
@@ -0,0 +1,196 @@
+"""Pre-aggregated revenue totals for the admin dashboard.
+
+Every captured payment and refund bumps one row per granularity (hour, day,
+month) keyed by bucket, currency and status. A range query then reads one
+row per bucket instead of every receipt. Amounts are kept as integer cents,
+so sums stay exact and rows stay small.
+
+Buckets are prefixes of the receipt date string ("2026-10-19 14",
+"2026-10-19", "2026-10"), so they sort and compare as plain text.
+
+Writes may carry an event id (a capture or refund id). An id that has
+already been counted is ignored, so PayPal replays and retried requests
+cannot inflate the totals. The event itself is kept too, so one recorded
+while a rebuild is running can be added back once the rebuilt totals are
+swapped in.
+"""
+import sqlite3
+import threading
+from decimal import Decimal
+
+GRANULARITIES = {"hour": 13, "day": 10, "month": 7}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revenue_rollups (
+    granularity TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    PRIMARY KEY (granularity, bucket, currency, status)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_events (
+    event_id TEXT PRIMARY KEY,
+    date TEXT,
+    currency TEXT,
+    status TEXT,
+    count INTEGER,
+    amount_cents INTEGER
+);
+"""
+
+UPSERT = """
+INSERT INTO revenue_rollups (granularity, bucket, currency, status, count, amount_cents)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (granularity, bucket, currency, status)
+DO UPDATE SET count = count + excluded.count, amount_cents = amount_cents + excluded.amount_cents
+"""
+
+
+def to_cents(amount):
+    return int(Decimal(str(amount)) * 100)
+
+
+def from_cents(cents):
+    return str(Decimal(cents).scaleb(-2))
+
+
+def receipt_events(receipt):
+    """Yield the (date, currency, status, amount, count) events a stored receipt stands for."""
+    status = receipt["status"]
+    refunded_amount = receipt.get("refunded_amount")
+    # A refunded receipt was first a completed capture
+    if status in ("REFUNDED", "PARTIALLY_REFUNDED"):
+        status = "COMPLETED"
+    yield receipt["date"], receipt["currency"], status, receipt["amount"], 1
+    if refunded_amount:
+        # Partial refunds are folded into one total dated at the latest refund
+        yield (receipt.get("refund_date", receipt["date"]), receipt["currency"], "REFUNDED", refunded_amount,
+               receipt.get("refund_count", 1))
+
+
+def add_totals(totals, date, currency, status, count, cents):
+    for granularity, length in GRANULARITIES.items():
+        key = (granularity, date[:length], currency, status)
+        total_count, total_cents = totals.get(key, (0, 0))
+        totals[key] = (total_count + count, total_cents + cents)
+
+
+class RollupStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+
+    def connection(self):
+        # SQLite connections cannot be shared across threads, so each worker gets its own
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def record(self, date, currency, status, amount, count=1, event_id=None):
+        """Add an event to every granularity; returns False if event_id was already counted."""
+        cents = to_cents(amount)
+        rows = [(granularity, date[:length], currency, status, count, cents)
+                for granularity, length in GRANULARITIES.items()]
+        conn = self.connection()
+        with conn:
+            if event_id is not None:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO rollup_events (event_id, date, currency, status, count, amount_cents)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", (event_id, date, currency, status, count, cents)
+                )
+                if cursor.rowcount == 0:
+                    return False
+            conn.executemany(UPSERT, rows)
+        return True
+
+    def query(self, granularity, start=None, end=None, currency=None, status=None):
+        """Return one entry per matching bucket between start and end, inclusive.
+
+        start and end may be any prefix of a date ("2026-10", "2026-10-19 14");
+        end covers every bucket that starts with it.
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity '{granularity}'")
+        sql = "SELECT bucket, currency, status, count, amount_cents FROM revenue_rollups WHERE granularity = ?"
+        params = [granularity]
+        if start:
+            # "2026-10-19 14" at day granularity still has to include the "2026-10-19" bucket
+            sql += " AND bucket >= ?"
+            params.append(start[:GRANULARITIES[granularity]])
+        if end:
+            # '~' sorts after digits, '-' and ' ', so every bucket under the end prefix matches
+            sql += " AND bucket <= ?"
+            params.append(end + "~")
+        if currency:
+            sql += " AND currency = ?"
+            params.append(currency)
+        if status:
+            sql += " AND status = ?"
+            params.append(status)
+        sql += " ORDER BY bucket, currency, status"
+
+        return [{
+            "bucket": bucket,
+            "currency": row_currency,
+            "status": row_status,
+            "count": count,
+            "sum": from_cents(cents),
+            "average": str((Decimal(cents).scaleb(-2) / count).quantize(Decimal("0.01"))) if count else "0.00",
+        } for bucket, row_currency, row_status, count, cents in self.connection().execute(sql, params)]
+
+    def rebuild(self, receipts):
+        """Replace all rollups with totals computed from receipts in one streaming pass.
+
+        Only the aggregates are held in memory, so the receipts can be a
+        generator over a file of any size. The receipts' event ids go to a
+        temp table, which does not lock the stats database, so live writes
+        keep working during a long backfill. The write lock is taken only to
+        swap in the new totals. Events recorded meanwhile that the receipts
+        did not cover are added back on top.
+        """
+        totals = {}
+        processed = 0
+        event_ids = []
+        conn = self.connection()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS rebuilt_events (event_id TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute("DELETE FROM temp.rebuilt_events")
+        conn.commit()
+        started_after = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM rollup_events").fetchone()[0]
+        try:
+            for receipt in receipts:
+                for date, currency, status, amount, events in receipt_events(receipt):
+                    add_totals(totals, date, currency, status, events, to_cents(amount))
+                event_ids.append((f"capture:{receipt['transaction_id']}",))
+                event_ids.extend((f"refund:{refund_id}",) for refund_id in receipt.get("refund_ids", []))
+                if len(event_ids) >= 1000:
+                    conn.executemany("INSERT OR IGNORE INTO temp.rebuilt_events (event_id) VALUES (?)", event_ids)
+                    event_ids = []
+                processed += 1
+            conn.executemany("INSERT OR IGNORE INTO temp.rebuilt_events (event_id) VALUES (?)", event_ids)
+            conn.commit()
+
+            conn.execute("BEGIN IMMEDIATE")
+            live = conn.execute(
+                "SELECT date, currency, status, count, amount_cents FROM rollup_events WHERE rowid > ?"
+                " AND event_id NOT IN (SELECT event_id FROM temp.rebuilt_events)", (started_after,)
+            ).fetchall()
+            for date, currency, status, count, cents in live:
+                add_totals(totals, date, currency, status, count, cents)
+            conn.execute("DELETE FROM rollup_events WHERE rowid <= ?", (started_after,))
+            # Rebuilt ids only guard against replays; their amounts are already in the totals
+            conn.execute("INSERT OR IGNORE INTO rollup_events (event_id) SELECT event_id FROM temp.rebuilt_events")
+            conn.execute("DELETE FROM revenue_rollups")
+            conn.executemany(UPSERT, [(*key, count, cents) for key, (count, cents) in totals.items()])
+            conn.execute("DELETE FROM temp.rebuilt_events")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return processed, len(totals)
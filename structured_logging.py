@@ -0,0 +1,227 @@
+"""Non-blocking JSON logging for the checkout app.
+
+Request threads only sample, attach context and drop the record on a bounded
+queue. A background listener thread does the redaction, JSON encoding and
+I/O, so a slow log sink never shows up in request latency. When the queue is
+full, records are dropped and counted instead of blocking the caller; the
+count is logged as a ``log.records_dropped`` warning once there is room.
+
+The listener thread is started by the first record each process logs, so
+workers forked by ``gunicorn --preload`` get their own thread instead of a
+queue nobody drains.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+
+REDACTED = "[REDACTED]"
+SENSITIVE_KEYS = ("secret", "token", "password", "authorization", "client_id", "credentials")
+AUTH_HEADER_PATTERN = re.compile(r"\b(Bearer|Basic)\s+[A-Za-z0-9._~+/=-]+")
+
+log_context = contextvars.ContextVar("log_context", default={})
+
+
+def reset_log_context(**fields):
+    log_context.set(dict(fields))
+
+
+def bind_log_context(**fields):
+    log_context.set({**log_context.get(), **fields})
+
+
+def parse_sample_rates(spec):
+    # "paypal.request=0.1,payment.page_view=0.01" -> {"paypal.request": 0.1, ...}
+    rates = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+def log_event(logger, event, level=logging.INFO, exc_info=None, **fields):
+    if not logger.isEnabledFor(level):
+        return
+    # Sample before a LogRecord exists; dropped events then cost almost nothing
+    rate = getattr(logger, "sample_rates", {}).get(event) if level < logging.WARNING else None
+    if rate is not None and random.random() >= rate:
+        return
+    if exc_info and not isinstance(exc_info, tuple):
+        exc_info = sys.exc_info()
+    # makeRecord directly skips Logger.findCaller's stack walk
+    record = logger.makeRecord(logger.name, level, "", 0, event, None, exc_info,
+                               extra={"event": event, "fields": fields})
+    if rate is not None:
+        record.sample_rate = rate
+    logger.handle(record)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the caller's request context onto the record before it leaves the thread."""
+
+    def filter(self, record):
+        record.context = log_context.get()
+        return True
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # put_nowait would raise on a full queue and stop() would abandon the backlog
+        self.queue.put(self._sentinel)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, targets, queue_size):
+        super().__init__(None)
+        self.targets = targets
+        self.queue_size = queue_size
+        self.queue_listener = None
+        self.pid = None
+        self.dropped = 0
+        self.reported = 0
+        self.start_lock = threading.Lock()
+        self.drop_lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        # The parent's lock may have been held mid-fork and its thread did not survive
+        self.start_lock = threading.Lock()
+        self.drop_lock = threading.Lock()
+        self.queue_listener = None
+        # The parent's drops are reported by the parent
+        self.dropped = self.reported = 0
+
+    def ensure_listener(self):
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=self.queue_size)
+                self.queue_listener = DrainingQueueListener(self.queue, *self.targets)
+                self.queue_listener.start()
+                self.pid = os.getpid()
+
+    def stop(self):
+        """Flush queued records and stop this process's listener thread."""
+        listener = self.queue_listener
+        if self.pid == os.getpid() and listener is not None and listener._thread is not None:
+            listener.stop()
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread; the record stays in-process
+        return record
+
+    def enqueue(self, record):
+        self.ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+            return
+        if self.dropped != self.reported:
+            self.report_dropped(record.name)
+
+    def report_dropped(self, name):
+        with self.drop_lock:
+            count = self.dropped - self.reported
+            self.reported = self.dropped
+            total = self.dropped
+        if count <= 0:
+            return
+        notice = logging.LogRecord(name, logging.WARNING, "", 0, "log.records_dropped", None, None)
+        notice.event = "log.records_dropped"
+        notice.fields = {"dropped": count, "total_dropped": total}
+        try:
+            self.queue.put_nowait(notice)
+        except queue.Full:
+            with self.drop_lock:
+                self.reported -= count
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, secrets=()):
+        super().__init__()
+        # Very short values would blank out ordinary words, so only scrub real credentials
+        self.secrets = [secret for secret in secrets if secret and len(secret) >= 8]
+
+    def scrub(self, text):
+        text = AUTH_HEADER_PATTERN.sub(lambda match: f"{match.group(1)} {REDACTED}", text)
+        for secret in self.secrets:
+            text = text.replace(secret, REDACTED)
+        return text
+
+    def redact(self, value, key=""):
+        if key and any(marker in key.lower() for marker in SENSITIVE_KEYS):
+            return REDACTED
+        if isinstance(value, dict):
+            return {k: self.redact(v, str(k)) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.redact(v) for v in value]
+        if isinstance(value, str):
+            return self.scrub(value)
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        return self.scrub(str(value))
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None) or record.getMessage(),
+        }
+        entry.update(getattr(record, "context", {}))
+        entry.update(getattr(record, "fields", {}))
+        if not hasattr(record, "event"):
+            entry["message"] = record.getMessage()
+        if hasattr(record, "sample_rate"):
+            entry["sample_rate"] = record.sample_rate
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(self.redact(entry), default=str)
+
+
+def configure_logging(name, level="INFO", stream=None, sample_rates=None, secrets=(), queue_size=10000):
+    """Return a logger whose records are written by a background thread.
+
+    ``sample_rates`` maps event names to the fraction of INFO/DEBUG records
+    kept by ``log_event``; warnings and errors are never sampled. Calling it
+    again for the same name returns the already configured logger.
+    """
+    logger = logging.getLogger(name)
+    if getattr(logger, "queue_handler", None):
+        return logger
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter(secrets))
+
+    handler = DroppingQueueHandler([output], queue_size)
+    handler.addFilter(ContextFilter())
+
+    logger.setLevel(level)
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.queue_handler = handler
+    logger.sample_rates = sample_rates or {}
+
+    atexit.register(shutdown_logging, logger)
+    return logger
+
+
+def shutdown_logging(logger):
+    """Flush queued records and stop the listener thread."""
+    handler = getattr(logger, "queue_handler", None)
+    if handler is not None:
+        handler.stop()
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py reads its settings at import time; keep test runs out of the working tree
+STATE_DIR = tempfile.mkdtemp(prefix="checkout-tests-")
+for name, filename in (("RECEIPTS_DB_PATH", "receipts.db"), ("STATS_DB_PATH", "stats.db"),
+                       ("BILLING_DB_PATH", "billing.db"), ("VELOCITY_STATE_PATH", "velocity.bin")):
+    os.environ[name] = os.path.join(STATE_DIR, filename)
+os.environ["ADMIN_API_TOKEN"] = "test-admin-token"
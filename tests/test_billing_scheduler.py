@@ -0,0 +1,156 @@
+import pytest
+
+from billing_scheduler import BillingScheduler, connect, period_start
+
+DAY = 86400
+ANCHOR = 1_700_000_000.0
+
+
+class FakeCharge:
+    def __init__(self):
+        self.declined = set()
+        self.calls = []
+
+    def __call__(self, subscription, period, idempotency_key):
+        self.calls.append((subscription["id"], period, idempotency_key))
+        if subscription["payer_email"] in self.declined:
+            raise Exception("INSTRUMENT_DECLINED")
+        return {"order_id": f"ORDER-{period}", "transaction_id": f"TX-{subscription['id']}-{period}"}
+
+
+@pytest.fixture
+def charge():
+    return FakeCharge()
+
+
+@pytest.fixture
+def scheduler(charge):
+    return BillingScheduler(connect(":memory:"), charge, workers=2, jitter_seconds=0,
+                            max_catch_up=2, max_failures=2, retry_delay=3600)
+
+
+def charges(scheduler, subscription_id):
+    rows = scheduler.conn.execute(
+        "SELECT period, status FROM subscription_charges WHERE subscription_id = ? ORDER BY period", (subscription_id,)
+    )
+    return [(row["period"], row["status"]) for row in rows]
+
+
+def subscription(scheduler, subscription_id):
+    return dict(scheduler.conn.execute("SELECT * FROM subscriptions WHERE id = ?", (subscription_id,)).fetchone())
+
+
+def test_plan_catches_up_recent_periods_and_skips_older_ones(scheduler):
+    subscription_id = scheduler.add_subscription("a@example.com", "V1", "5.00", interval_unit="day", anchor_at=ANCHOR)
+
+    periods, skipped = scheduler.plan(subscription(scheduler, subscription_id), ANCHOR + 4 * DAY + 1)
+
+    assert periods == [3, 4]
+    assert skipped == [0, 1, 2]
+
+
+@pytest.mark.parametrize("interval_count", [0, -1])
+def test_interval_count_below_one_is_rejected(scheduler, interval_count):
+    with pytest.raises(ValueError):
+        scheduler.add_subscription("a@example.com", "V1", "5.00", interval_unit="day",
+                                   interval_count=interval_count, anchor_at=ANCHOR)
+
+    assert scheduler.conn.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0] == 0
+
+
+def test_run_due_records_charges_and_schedules_next_period(scheduler, charge):
+    subscription_id = scheduler.add_subscription("a@example.com", "V1", "5.00", interval_unit="day", anchor_at=ANCHOR)
+
+    scheduler.run_due(ANCHOR + 4 * DAY + 1)
+
+    assert charges(scheduler, subscription_id) == [(0, "SKIPPED"), (1, "SKIPPED"), (2, "SKIPPED"),
+                                                   (3, "COMPLETED"), (4, "COMPLETED")]
+    assert [key for _, _, key in charge.calls] == [f"subscription-{subscription_id}-3",
+                                                   f"subscription-{subscription_id}-4"]
+    row = subscription(scheduler, subscription_id)
+    assert row["next_period"] == 5
+    assert row["next_run_at"] == period_start(ANCHOR, "day", 1, 5)
+    assert scheduler.next_run_at() == row["next_run_at"]
+
+
+def test_nothing_is_charged_twice_for_a_period(scheduler, charge):
+    scheduler.add_subscription("a@example.com", "V1", "5.00", interval_unit="day", anchor_at=ANCHOR)
+
+    scheduler.run_due(ANCHOR + 1)
+    scheduler.load()
+    scheduler.run_due(ANCHOR + 2)
+
+    assert len(charge.calls) == 1
+
+
+def test_charges_finished_before_a_crash_are_kept(charge):
+    scheduler = BillingScheduler(connect(":memory:"), charge, workers=1, jitter_seconds=0)
+    first = scheduler.add_subscription("a@example.com", "V1", "5.00", interval_unit="day", anchor_at=ANCHOR)
+    second = scheduler.add_subscription("crash@example.com", "V2", "5.00", interval_unit="day", anchor_at=ANCHOR)
+
+    def crash_on_second(subscription, period, idempotency_key):
+        if subscription["id"] == second:
+            raise SystemExit("worker killed")
+        return charge(subscription, period, idempotency_key)
+
+    scheduler.charge = crash_on_second
+    with pytest.raises(SystemExit):
+        scheduler.run_due(ANCHOR + 1)
+
+    assert charges(scheduler, first) == [(0, "COMPLETED")]
+    assert charges(scheduler, second) == []
+    scheduler.charge = charge
+    scheduler.load()
+    scheduler.run_due(ANCHOR + 2)
+    assert [subscription_id for subscription_id, _, _ in charge.calls] == [first, second]
+
+
+def test_failed_attempts_are_recorded_and_retried(scheduler, charge):
+    charge.declined.add("bad@example.com")
+    subscription_id = scheduler.add_subscription("bad@example.com", "V2", "5.00", interval_unit="month",
+                                                 anchor_at=ANCHOR)
+
+    scheduler.run_due(ANCHOR + 1)
+
+    attempts = scheduler.conn.execute("SELECT period, status, error FROM subscription_attempts").fetchall()
+    assert [tuple(attempt) for attempt in attempts] == [(0, "FAILED", "INSTRUMENT_DECLINED")]
+    assert charges(scheduler, subscription_id) == []
+    row = subscription(scheduler, subscription_id)
+    assert (row["status"], row["failures"], row["next_period"]) == ("ACTIVE", 1, 0)
+    assert row["next_run_at"] == ANCHOR + 1 + 3600
+
+
+def test_repeated_failures_mark_past_due_until_resumed(scheduler, charge):
+    charge.declined.add("bad@example.com")
+    subscription_id = scheduler.add_subscription("bad@example.com", "V2", "5.00", interval_unit="month",
+                                                 anchor_at=ANCHOR)
+
+    scheduler.run_due(ANCHOR + 1)
+    scheduler.run_due(ANCHOR + 3602)
+
+    assert subscription(scheduler, subscription_id)["status"] == "PAST_DUE"
+    assert scheduler.run_due(ANCHOR + 10 * 3600) == []
+
+    charge.declined.clear()
+    assert scheduler.resume_subscription(subscription_id, now=ANCHOR + 20 * 3600)
+    assert not scheduler.resume_subscription(subscription_id)
+    scheduler.run_due(ANCHOR + 20 * 3600)
+
+    assert charges(scheduler, subscription_id) == [(0, "COMPLETED")]
+    row = subscription(scheduler, subscription_id)
+    assert (row["status"], row["failures"], row["next_period"]) == ("ACTIVE", 0, 1)
+
+
+def test_cancelled_subscription_is_not_charged(scheduler, charge):
+    subscription_id = scheduler.add_subscription("a@example.com", "V1", "5.00", interval_unit="day", anchor_at=ANCHOR)
+    scheduler.cancel_subscription(subscription_id)
+
+    assert scheduler.run_due(ANCHOR + DAY) == []
+    assert charge.calls == []
+
+
+def test_monthly_periods_do_not_drift_after_short_months():
+    jan_31 = 1_706_659_200.0  # 2024-01-31 00:00 UTC
+
+    assert period_start(jan_31, "month", 1, 1) == 1_709_164_800.0  # 2024-02-29
+    assert period_start(jan_31, "month", 1, 2) == 1_711_843_200.0  # 2024-03-31
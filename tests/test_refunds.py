@@ -0,0 +1,193 @@
+import json
+
+import pytest
+
+import app as checkout
+from receipt_store import ReceiptStore
+from revenue_rollups import RollupStore
+
+ADMIN = {"Authorization": "Bearer test-admin-token"}
+
+
+class FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+        self.text = json.dumps(data)
+
+    def json(self):
+        return self.data
+
+
+class FakePayPal:
+    """Answers refunds the way PayPal does: one refund per PayPal-Request-Id."""
+
+    def __init__(self):
+        self.refunds = {}
+        self.calls = []
+
+    def __call__(self, url, json=None, headers=None, **kwargs):
+        key = headers["PayPal-Request-Id"]
+        self.calls.append(key)
+        if url.endswith("/void"):
+            return FakeResponse(204, {})
+        refund_id = self.refunds.setdefault(key, f"RF{len(self.refunds) + 1}")
+        value = (json or {}).get("amount", {}).get("value", "10.00")
+        return FakeResponse(201, {"id": refund_id, "status": "COMPLETED",
+                                  "amount": {"value": value, "currency_code": "USD"}})
+
+
+@pytest.fixture
+def paypal(monkeypatch):
+    fake = FakePayPal()
+    monkeypatch.setattr(checkout.paypal_session, "post", fake)
+    monkeypatch.setattr(checkout, "get_access_token", lambda: "token")
+    return fake
+
+
+@pytest.fixture
+def receipts(tmp_path, monkeypatch):
+    store = ReceiptStore(str(tmp_path / "receipts.db"))
+    monkeypatch.setattr(checkout, "receipt_data_store", store)
+    for transaction_id in ("T1", "T2"):
+        store[transaction_id] = {"transaction_id": transaction_id, "order_id": "O", "amount": "10.00",
+                                 "currency": "USD", "status": "COMPLETED", "date": "2026-10-19 14:00:00"}
+    return store
+
+
+@pytest.fixture
+def rollups(tmp_path, monkeypatch):
+    store = RollupStore(str(tmp_path / "stats.db"))
+    monkeypatch.setattr(checkout, "revenue_rollups", store)
+    return store
+
+
+def refunded(rollups):
+    return [(row["count"], row["sum"]) for row in rollups.query("month", status="REFUNDED")]
+
+
+def test_read_refund_file_dedupes_rows_and_keeps_explicit_keys(tmp_path):
+    path = tmp_path / "refunds.csv"
+    path.write_text("transaction_id,amount,action,currency,key\n"
+                    "T1,5.00\n"
+                    "T1,5.00\n"
+                    "T1,5.00,refund,USD,second-refund\n"
+                    "# comment\n"
+                    "A1,,void\n"
+                    "T2\n")
+
+    jobs = checkout.read_refund_file(str(path))
+
+    assert [job["idempotency_key"] for job in jobs] == [
+        "refund-T1-5.00", "second-refund", "void-A1", "refund-T2-full"]
+    assert jobs[0]["amount"] == "5.00" and jobs[3]["amount"] is None
+
+
+def test_read_refund_file_rejects_unknown_actions(tmp_path):
+    path = tmp_path / "refunds.csv"
+    path.write_text("T1,5.00,chargeback\n")
+
+    with pytest.raises(ValueError):
+        checkout.read_refund_file(str(path))
+
+
+def test_checkpoint_skips_truncated_last_line_only(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    path.write_text(json.dumps({"idempotency_key": "a", "status": "COMPLETED"}) + "\n"
+                    + json.dumps({"idempotency_key": "b", "status": "FAILED"}) + "\n"
+                    + '{"idempotency_key": "c", "sta')
+
+    assert list(checkout.load_refund_checkpoint(str(path))) == ["a"]
+
+    path.write_text('{"idempotency_key": "c", "sta\n' + json.dumps({"idempotency_key": "a", "status": "COMPLETED"}))
+    with pytest.raises(json.JSONDecodeError):
+        checkout.load_refund_checkpoint(str(path))
+
+
+def test_replayed_refund_result_is_applied_once(receipts, rollups):
+    result = {"status": "COMPLETED", "action": "refund", "transaction_id": "T1", "paypal_id": "RF1",
+              "refunded_amount": "5.00", "currency": "USD"}
+
+    checkout.apply_refund_results([result])
+    checkout.apply_refund_results([result])
+
+    receipt = receipts["T1"]
+    assert (receipt["status"], receipt["refunded_amount"], receipt["refund_count"]) == ("PARTIALLY_REFUNDED", "5.00", 1)
+    assert refunded(rollups) == [(1, "5.00")]
+
+
+def test_interrupted_bulk_refund_is_applied_on_rerun(tmp_path, paypal, receipts, rollups):
+    jobs = [{"transaction_id": transaction_id, "amount": None, "action": "refund", "currency": "USD",
+             "idempotency_key": checkout.refund_idempotency_key(transaction_id)} for transaction_id in ("T1", "T2")]
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+
+    def interrupt(result):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        checkout.process_bulk_refunds(jobs, checkpoint, workers=1, on_result=interrupt)
+    assert len(checkout.load_refund_checkpoint(checkpoint)) == 1
+    assert [receipts[t]["status"] for t in ("T1", "T2")].count("REFUNDED") == 1
+
+    results, skipped = checkout.process_bulk_refunds(jobs, checkpoint, workers=1)
+
+    assert (len(results), skipped) == (1, 1)
+    for transaction_id in ("T1", "T2"):
+        assert (receipts[transaction_id]["status"], receipts[transaction_id]["refund_count"]) == ("REFUNDED", 1)
+    assert refunded(rollups) == [(2, "20.00")]
+
+
+def test_checkpoint_from_a_crashed_run_updates_receipts(tmp_path, paypal, receipts, rollups):
+    # PayPal refunded T1, but the run died before the receipt was written
+    checkpoint = tmp_path / "checkpoint.jsonl"
+    checkpoint.write_text(json.dumps({"idempotency_key": "refund-T1-full", "transaction_id": "T1", "action": "refund",
+                                      "amount": None, "status": "COMPLETED", "paypal_id": "RF9",
+                                      "refunded_amount": "10.00", "currency": "USD"}) + "\n")
+    jobs = [{"transaction_id": "T1", "amount": None, "action": "refund", "currency": "USD",
+             "idempotency_key": "refund-T1-full"}]
+
+    assert checkout.process_bulk_refunds(jobs, str(checkpoint)) == ([], 1)
+    assert checkout.process_bulk_refunds(jobs, str(checkpoint)) == ([], 1)
+
+    assert paypal.calls == []
+    assert receipts["T1"]["status"] == "REFUNDED"
+    assert refunded(rollups) == [(1, "10.00")]
+
+
+def test_receipt_edit_saves_changes_and_rolls_back_on_error(receipts):
+    with receipts.edit("T1") as receipt:
+        receipt["status"] = "REFUNDED"
+    assert receipts["T1"]["status"] == "REFUNDED"
+
+    with pytest.raises(RuntimeError):
+        with receipts.edit("T2") as receipt:
+            receipt["status"] = "REFUNDED"
+            raise RuntimeError("boom")
+    assert receipts["T2"]["status"] == "COMPLETED"
+
+    with receipts.edit("missing") as receipt:
+        assert receipt is None
+    assert "missing" not in receipts
+
+
+def test_admin_refund_requires_an_idempotency_key(paypal, receipts, rollups):
+    client = checkout.app.test_client()
+
+    assert client.post("/admin/refund/T1", data={"amount": "5.00"}).status_code == 401
+    assert client.post("/admin/refund/T1", data={"amount": "5.00"}, headers=ADMIN).status_code == 400
+    too_long = {**ADMIN, "Idempotency-Key": "k" * 101}
+    assert client.post("/admin/refund/T1", data={"amount": "5.00"}, headers=too_long).status_code == 400
+    assert paypal.calls == []
+
+
+def test_admin_refund_retry_with_the_same_key_refunds_once(paypal, receipts, rollups):
+    client = checkout.app.test_client()
+    headers = {**ADMIN, "Idempotency-Key": "ticket-42"}
+
+    first = client.post("/admin/refund/T1", data={"amount": "5.00"}, headers=headers)
+    retry = client.post("/admin/refund/T1", data={"amount": "5.00"}, headers=headers)
+
+    assert first.json["refund_id"] == retry.json["refund_id"]
+    assert retry.json["receipt_status"] == "PARTIALLY_REFUNDED"
+    assert receipts["T1"]["refunded_amount"] == "5.00"
+    assert refunded(rollups) == [(1, "5.00")]
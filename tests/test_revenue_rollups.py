@@ -0,0 +1,101 @@
+import pytest
+
+from revenue_rollups import RollupStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return RollupStore(str(tmp_path / "stats.db"))
+
+
+def totals(rows):
+    return [(row["bucket"], row["status"], row["count"], row["sum"]) for row in rows]
+
+
+def test_record_and_query_every_granularity(store):
+    store.record("2026-10-19 14:05:00", "USD", "COMPLETED", "10.00")
+    store.record("2026-10-19 15:30:00", "USD", "COMPLETED", "2.50")
+    store.record("2026-10-20 09:00:00", "USD", "COMPLETED", "1.25")
+
+    assert totals(store.query("hour")) == [
+        ("2026-10-19 14", "COMPLETED", 1, "10.00"),
+        ("2026-10-19 15", "COMPLETED", 1, "2.50"),
+        ("2026-10-20 09", "COMPLETED", 1, "1.25"),
+    ]
+    assert totals(store.query("day")) == [
+        ("2026-10-19", "COMPLETED", 2, "12.50"),
+        ("2026-10-20", "COMPLETED", 1, "1.25"),
+    ]
+    assert totals(store.query("month")) == [("2026-10", "COMPLETED", 3, "13.75")]
+    assert store.query("day")[0]["average"] == "6.25"
+
+
+def test_query_filters_and_end_prefix(store):
+    store.record("2026-10-19 14:05:00", "USD", "COMPLETED", "10.00")
+    store.record("2026-10-19 14:06:00", "EUR", "COMPLETED", "3.00")
+    store.record("2026-11-01 00:00:00", "USD", "REFUNDED", "4.00")
+
+    assert totals(store.query("day", end="2026-10", currency="USD")) == [("2026-10-19", "COMPLETED", 1, "10.00")]
+    assert totals(store.query("month", status="REFUNDED")) == [("2026-11", "REFUNDED", 1, "4.00")]
+
+
+def test_start_more_specific_than_granularity_keeps_its_bucket(store):
+    store.record("2026-10-18 23:00:00", "USD", "COMPLETED", "1.00")
+    store.record("2026-10-19 16:00:00", "USD", "COMPLETED", "10.00")
+
+    assert [row["bucket"] for row in store.query("day", start="2026-10-19 14")] == ["2026-10-19"]
+    assert [row["bucket"] for row in store.query("month", start="2026-10-19")] == ["2026-10"]
+
+
+def test_replayed_event_is_counted_once(store):
+    assert store.record("2026-10-19 14:05:00", "USD", "REFUNDED", "5.00", event_id="refund:R1")
+    assert not store.record("2026-10-19 14:05:00", "USD", "REFUNDED", "5.00", event_id="refund:R1")
+
+    assert totals(store.query("day")) == [("2026-10-19", "REFUNDED", 1, "5.00")]
+
+
+def test_rebuild_matches_recorded_totals_and_keeps_event_ids(store):
+    receipts = [
+        {"transaction_id": "T1", "amount": "10.00", "currency": "USD", "status": "PARTIALLY_REFUNDED",
+         "date": "2026-10-19 14:05:00", "refunded_amount": "5.00", "refund_date": "2026-10-20 08:00:00",
+         "refund_count": 1, "refund_ids": ["R1"]},
+        {"transaction_id": "T2", "amount": "7.50", "currency": "USD", "status": "COMPLETED",
+         "date": "2026-10-19 18:00:00"},
+    ]
+    store.record("2026-10-19 14:05:00", "USD", "COMPLETED", "10.00", event_id="capture:T1")
+    store.record("2026-10-19 18:00:00", "USD", "COMPLETED", "7.50", event_id="capture:T2")
+    store.record("2026-10-20 08:00:00", "USD", "REFUNDED", "5.00", event_id="refund:R1")
+    recorded = store.query("hour")
+
+    # A generator, as the backfill command streams receipts
+    assert store.rebuild(receipt for receipt in receipts) == (2, 7)
+    assert store.query("hour") == recorded
+    assert totals(store.query("day")) == [
+        ("2026-10-19", "COMPLETED", 2, "17.50"),
+        ("2026-10-20", "REFUNDED", 1, "5.00"),
+    ]
+    assert not store.record("2026-10-20 08:00:00", "USD", "REFUNDED", "5.00", event_id="refund:R1")
+    assert not store.record("2026-10-19 18:00:00", "USD", "COMPLETED", "7.50", event_id="capture:T2")
+
+
+def test_live_records_during_rebuild_are_not_blocked_or_lost(tmp_path):
+    store = RollupStore(str(tmp_path / "stats.db"))
+    live = RollupStore(str(tmp_path / "stats.db"))
+    live.connection().execute("PRAGMA busy_timeout = 100")
+    receipt = {"transaction_id": "T1", "amount": "10.00", "currency": "USD", "status": "COMPLETED",
+               "date": "2026-10-19 14:05:00"}
+
+    def receipts():
+        # Both writes would hit "database is locked" if the rebuild held the write lock
+        assert live.record("2026-10-19 15:00:00", "USD", "COMPLETED", "10.00", event_id="capture:T1")
+        assert live.record("2026-10-19 16:00:00", "USD", "REFUNDED", "2.00", event_id="refund:R7")
+        yield receipt
+
+    store.rebuild(receipts())
+
+    assert totals(store.query("day")) == [
+        ("2026-10-19", "COMPLETED", 1, "10.00"),
+        ("2026-10-19", "REFUNDED", 1, "2.00"),
+    ]
+    assert not store.record("2026-10-19 16:00:00", "USD", "REFUNDED", "2.00", event_id="refund:R7")
+    assert not store.record("2026-10-19 15:00:00", "USD", "COMPLETED", "10.00", event_id="capture:T1")
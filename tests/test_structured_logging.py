@@ -0,0 +1,151 @@
+import io
+import json
+import logging
+import os
+import threading
+
+import pytest
+
+from structured_logging import (DroppingQueueHandler, JsonFormatter, configure_logging, log_event,
+                                reset_log_context, shutdown_logging)
+
+
+@pytest.fixture
+def capture(request):
+    """Configure a fresh logger and return (logger, read) where read() flushes and parses the output."""
+    stream = io.StringIO()
+
+    def make(**kwargs):
+        logger = configure_logging(f"test.{request.node.name}.{len(loggers)}", stream=stream, **kwargs)
+        loggers.append(logger)
+        return logger
+
+    def read():
+        for logger in loggers:
+            shutdown_logging(logger)
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    loggers = []
+    yield make, read
+    for logger in loggers:
+        shutdown_logging(logger)
+
+
+class BlockingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.unblock = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.unblock.wait(5)
+        self.records.append(record)
+
+
+def test_events_carry_context_and_fields(capture):
+    make, read = capture
+    logger = make()
+    reset_log_context(request_id="req-1")
+
+    log_event(logger, "payment.captured", transaction_id="TX1", amount="10.00")
+
+    [entry] = read()
+    assert (entry["event"], entry["level"], entry["request_id"]) == ("payment.captured", "INFO", "req-1")
+    assert (entry["transaction_id"], entry["amount"]) == ("TX1", "10.00")
+
+
+def test_sensitive_keys_auth_headers_and_secrets_are_redacted(capture):
+    make, read = capture
+    logger = make(secrets=["sk_live_0123456789", "short"])
+
+    log_event(logger, "paypal.request", access_token="abc", client_secret="xyz",
+              headers={"Authorization": "Basic dXNlcjpwYXNz", "Accept": "application/json"},
+              error="401 for Bearer A21AAF.x-y_z and sk_live_0123456789", note="a short note")
+
+    [entry] = read()
+    assert entry["access_token"] == entry["client_secret"] == "[REDACTED]"
+    assert entry["headers"] == {"Authorization": "[REDACTED]", "Accept": "application/json"}
+    assert entry["error"] == "401 for Bearer [REDACTED] and [REDACTED]"
+    # Secrets under 8 characters are not scrubbed from ordinary text
+    assert entry["note"] == "a short note"
+
+
+def test_sampling_never_drops_warnings(capture):
+    make, read = capture
+    logger = make(sample_rates={"paypal.request": 0.0})
+
+    for _ in range(50):
+        log_event(logger, "paypal.request", status_code=201)
+    log_event(logger, "paypal.request", logging.WARNING, status_code=500)
+    log_event(logger, "paypal.request", logging.ERROR, status_code=502)
+
+    assert [(entry["level"], entry["status_code"]) for entry in read()] == [("WARNING", 500), ("ERROR", 502)]
+
+
+def test_kept_samples_record_their_rate(capture):
+    make, read = capture
+    logger = make(sample_rates={"paypal.request": 1.0})
+
+    log_event(logger, "paypal.request", status_code=201)
+
+    assert read()[0]["sample_rate"] == 1.0
+
+
+def test_full_queue_drops_records_and_reports_the_count():
+    target = BlockingHandler()
+    handler = DroppingQueueHandler([target], queue_size=2)
+    logger = logging.getLogger("test.dropping")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(10):
+            log_event(logger, "payment.page_view", i=i)
+        # One record is held by the blocked listener and two wait in the queue
+        assert handler.dropped >= 7
+
+        target.unblock.set()
+        handler.queue.join()
+        log_event(logger, "payment.page_view", i=10)
+        handler.stop()
+    finally:
+        logger.removeHandler(handler)
+
+    notices = [record for record in target.records if record.event == "log.records_dropped"]
+    assert len(notices) == 1
+    assert notices[0].levelno == logging.WARNING
+    assert notices[0].fields == {"dropped": handler.dropped, "total_dropped": handler.dropped}
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_child_starts_its_own_listener(tmp_path):
+    path = tmp_path / "log.jsonl"
+    with open(path, "a") as stream:
+        logger = configure_logging("test.fork", stream=stream)
+        log_event(logger, "parent.before_fork")
+        parent_listener = logger.queue_handler.queue_listener
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                log_event(logger, "child.event", pid=os.getpid())
+                status = 0 if logger.queue_handler.queue_listener is not parent_listener else 1
+                shutdown_logging(logger)
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        log_event(logger, "parent.after_fork")
+        shutdown_logging(logger)
+
+    assert os.waitstatus_to_exitcode(status) == 0
+    events = [json.loads(line)["event"] for line in path.read_text().splitlines()]
+    assert sorted(events) == ["child.event", "parent.after_fork", "parent.before_fork"]
+
+
+def test_formatter_keeps_plain_log_messages():
+    record = logging.LogRecord("test", logging.INFO, "", 0, "started %s", ("worker",), None)
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert (entry["event"], entry["message"]) == ("started worker", "started worker")
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from velocity_checks import VelocityGuard, parse_rules
+
+NOW = 1_700_000_000.0
+
+
+def make_guard(tmp_path, spec, **kwargs):
+    kwargs.setdefault("peak_rate", 100)
+    return VelocityGuard(str(tmp_path / "velocity.bin"), parse_rules(spec), **kwargs)
+
+
+def test_limit_allows_up_to_limit_then_rejects(tmp_path):
+    guard = make_guard(tmp_path, "ip=3/60")
+
+    assert [guard.check(NOW + i, ip="1.1.1.1") for i in range(3)] == [None] * 3
+    assert guard.check(NOW + 3, ip="1.1.1.1").dimension == "ip"
+    assert guard.check(NOW + 3, ip="2.2.2.2") is None
+
+
+def test_window_expiry_frees_the_key(tmp_path):
+    guard = make_guard(tmp_path, "ip=2/60")
+    guard.check(NOW, ip="1.1.1.1")
+    guard.check(NOW + 1, ip="1.1.1.1")
+    assert guard.check(NOW + 30, ip="1.1.1.1") is not None
+
+    # Both attempts have left the 60 second window
+    assert guard.check(NOW + 75, ip="1.1.1.1") is None
+
+
+def test_rejected_attempts_do_not_extend_the_block(tmp_path):
+    guard = make_guard(tmp_path, "ip=2/60")
+    guard.check(NOW, ip="1.1.1.1")
+    guard.check(NOW, ip="1.1.1.1")
+    for second in range(1, 60, 5):
+        assert guard.check(NOW + second, ip="1.1.1.1") is not None
+
+    assert guard.check(NOW + 75, ip="1.1.1.1") is None
+
+
+def test_rejected_attempt_is_not_counted_by_other_rules(tmp_path):
+    guard = make_guard(tmp_path, "email=1/300,ip=2/60")
+    assert guard.check(NOW, ip="1.1.1.1", email="a@example.com") is None
+    assert guard.check(NOW, ip="1.1.1.1", email="a@example.com").dimension == "email"
+
+    # The rejected attempt above did not use up the IP's second slot
+    assert guard.check(NOW, ip="1.1.1.1", email="b@example.com") is None
+
+
+def test_combined_rule_counts_per_client(tmp_path):
+    guard = make_guard(tmp_path, "ip+amount=2/60")
+
+    # Many clients paying the same amount do not block each other
+    assert all(guard.check(NOW, ip=f"10.0.0.{i}", amount="25.00") is None for i in range(50))
+    guard.check(NOW, ip="10.0.0.1", amount="25.00")
+    assert guard.check(NOW, ip="10.0.0.1", amount="25.00").dimension == "ip+amount"
+    assert guard.check(NOW, ip="10.0.0.1", amount="30.00") is None
+    # A combined rule is skipped when any of its parts is missing
+    assert guard.check(NOW, amount="25.00") is None
+
+
+def test_state_is_shared_through_the_file(tmp_path):
+    first = make_guard(tmp_path, "ip=2/60")
+    second = make_guard(tmp_path, "ip=2/60")
+    first.check(NOW, ip="1.1.1.1")
+    second.check(NOW, ip="1.1.1.1")
+
+    assert first.check(NOW, ip="1.1.1.1") is not None
+
+
+def test_different_layout_uses_its_own_file(tmp_path):
+    old = make_guard(tmp_path, "ip=1/60")
+    old.check(NOW, ip="1.1.1.1")
+    new = make_guard(tmp_path, "ip=1/60,email=5/300")
+
+    assert new.path != old.path
+    assert old.check(NOW, ip="1.1.1.1") is not None
+    assert os.path.getsize(old.path) == old.size
+
+
+def test_refuses_symlinks_and_mismatched_files(tmp_path):
+    guard = make_guard(tmp_path, "ip=1/60")
+    path = guard.path
+    del guard
+    os.remove(path)
+    os.symlink(tmp_path / "elsewhere", path)
+    with pytest.raises(OSError):
+        make_guard(tmp_path, "ip=1/60")
+
+    os.remove(path)
+    with open(path, "wb") as f:
+        f.write(b"\0" * 16)
+    with pytest.raises(ValueError):
+        make_guard(tmp_path, "ip=1/60")
+
+
+def test_a_full_window_at_peak_rate_rarely_rejects_new_keys(tmp_path):
+    rate = 20
+    guard = make_guard(tmp_path, "email=5/300", peak_rate=rate)
+    checks = int(rate * 300 * 1.2)
+
+    rejected = sum(guard.check(NOW + i / rate, email=f"payer{i}@example.com") is not None for i in range(checks))
+
+    assert rejected / checks < 0.001
@@ -0,0 +1,194 @@
+"""Sliding-window velocity limits checked before any PayPal call.
+
+Each rule ("ip=10/60": at most 10 attempts per IP in 60 seconds) owns a
+ring of time slots covering its window. A rule may combine dimensions
+("ip+amount=5/60") to count per IP and amount together. Every slot is a
+count-min sketch, so memory is fixed no matter how many distinct IPs,
+emails or amounts show up. Estimates can only overcount, never undercount.
+
+Each rule's sketch is sized for ``peak_rate`` checks per second: a window's
+worth of distinct keys puts at most ``limit`` attempts on an average
+counter. Together with conservative updates (only the smallest counters
+of a key are raised) that keeps false rejects of legitimate first attempts
+well under 0.1% at the peak rate; benchmarks/bench_velocity.py checks it.
+
+The sketches live in a memory-mapped file, so every gunicorn worker on the
+host sees the same counts. Updates are serialised with flock plus a
+thread lock, which keeps a check in the tens of microseconds. Each layout
+(rules and sketch size) gets its own file next to the configured path, so
+a worker with new settings never resizes a file older workers have mapped.
+"""
+import hashlib
+import math
+import mmap
+import os
+import stat
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines; one process only
+    fcntl = None
+
+MAGIC = 0x56454C32  # "VEL2"
+HEADER_WORDS = 4
+COUNTER_MAX = 0xFFFF
+
+Rule = namedtuple("Rule", "dimension limit window")
+
+
+def parse_rules(spec):
+    # "ip=10/60,ip+amount=5/60" -> [Rule("ip", 10, 60), Rule("ip+amount", 5, 60)]
+    rules = []
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        dimension, limit = item.split("=", 1)
+        limit, window = limit.split("/", 1)
+        rules.append(Rule(dimension.strip(), int(limit), float(window)))
+    return rules
+
+
+def rule_key(rule, values):
+    # Every part of a combined dimension must be present, or the rule does not apply
+    parts = [values.get(part) for part in rule.dimension.split("+")]
+    if not all(parts):
+        return None
+    return "|".join(str(part) for part in parts)
+
+
+def sketch_width(rule, peak_rate):
+    # A full window of distinct keys averages at most `limit` per counter
+    return max(64, math.ceil(peak_rate * rule.window / rule.limit))
+
+
+class VelocityGuard:
+    def __init__(self, path, rules, slots=6, depth=4, peak_rate=10000):
+        if depth > 16:
+            raise ValueError("depth must be at most 16")
+        if any(not 0 < rule.limit < COUNTER_MAX for rule in rules):
+            raise ValueError(f"rule limits must be between 1 and {COUNTER_MAX - 1}")
+        self.rules = rules
+        self.slots = slots
+        self.depth = depth
+        self.widths = [sketch_width(rule, peak_rate) for rule in rules]
+        self.blocks = [depth * width for width in self.widths]
+        # Slot epochs are 32-bit words after the header; counters are 16-bit and follow them
+        self.counters_at = (HEADER_WORDS + len(rules) * slots) * 4
+        self.bases = []
+        offset = 0
+        for block in self.blocks:
+            self.bases.append(offset)
+            offset += slots * block
+        self.size = self.counters_at + offset * 2
+        # Layout fingerprint: a worker with different settings uses a different file
+        fingerprint = hashlib.blake2b(repr((MAGIC, slots, depth, self.widths, rules)).encode(), digest_size=4).digest()
+        self.layout = int.from_bytes(fingerprint, "little")
+        self.path = f"{path}.{self.layout:08x}"
+        self.zeros = memoryview(bytearray(max(self.blocks, default=0) * 2)).cast("H")
+        self.thread_lock = threading.Lock()
+        self.pid = None
+        if rules:
+            self.open()
+
+    def open(self):
+        # flock belongs to the open file, so a forked worker needs its own descriptor
+        self.pid = os.getpid()
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_CLOEXEC", 0)
+        self.fd = os.open(self.path, flags, 0o600)
+        try:
+            info = os.fstat(self.fd)
+            if not stat.S_ISREG(info.st_mode) or (hasattr(os, "getuid") and info.st_uid != os.getuid()):
+                raise PermissionError(f"{self.path} is not a regular file owned by this user")
+            with self.file_lock():
+                # Only a file nobody has mapped yet may be sized; anything else must already match
+                created = os.fstat(self.fd).st_size == 0
+                if created:
+                    os.ftruncate(self.fd, self.size)
+                elif os.fstat(self.fd).st_size != self.size:
+                    raise ValueError(f"{self.path} does not match the velocity rules; remove it")
+                self.mm = mmap.mmap(self.fd, self.size)
+                self.words = memoryview(self.mm)[:self.counters_at].cast("I")
+                self.counters = memoryview(self.mm)[self.counters_at:].cast("H")
+                if created:
+                    self.words[0] = MAGIC
+                    self.words[1] = self.layout
+                elif self.words[0] != MAGIC or self.words[1] != self.layout:
+                    raise ValueError(f"{self.path} does not match the velocity rules; remove it")
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    @contextmanager
+    def file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def cells(self, index, dimension, value):
+        width = self.widths[index]
+        digest = hashlib.blake2b(f"{dimension}:{value}".encode(), digest_size=4 * self.depth).digest()
+        return [row * width + int.from_bytes(digest[4 * row:4 * row + 4], "little") % width
+                for row in range(self.depth)]
+
+    def check(self, now=None, **values):
+        """Count one attempt for every rule whose dimensions are all given.
+
+        Returns the first rule the attempt would take over its limit, or None
+        when it is allowed. Only allowed attempts are counted, so a blocked
+        key frees up once its window passes, however often it keeps trying.
+        """
+        if not self.rules:
+            return None
+        now = time.time() if now is None else now
+        keyed = []
+        for index, rule in enumerate(self.rules):
+            key = rule_key(rule, values)
+            if key is not None:
+                keyed.append((index, rule, self.cells(index, rule.dimension, key)))
+        if not keyed:
+            return None
+        if self.pid != os.getpid():
+            self.open()
+
+        with self.thread_lock, self.file_lock():
+            counts = []
+            for index, rule, cells in keyed:
+                current, live = self.live_slots(index, rule, now)
+                totals = [sum(self.counters[start + cell] for start in live) for cell in cells]
+                if min(totals) >= rule.limit:
+                    return rule
+                counts.append((current, cells, totals))
+            counters = self.counters
+            for current, cells, totals in counts:
+                # Conservative update: raising only the rows at the minimum still never
+                # undercounts this key, and puts far less noise on every other key
+                lowest = min(totals)
+                for cell, total in zip(cells, totals):
+                    if total == lowest and counters[current + cell] < COUNTER_MAX:
+                        counters[current + cell] += 1
+        return None
+
+    def live_slots(self, index, rule, now):
+        """Return the offsets of the current slot and of every slot inside the window."""
+        words, counters, slots, block = self.words, self.counters, self.slots, self.blocks[index]
+        epochs = HEADER_WORDS + index * slots
+        base = self.bases[index]
+        epoch = int(now * slots / rule.window) & 0xFFFFFFFF
+        slot = epoch % slots
+        current = base + slot * block
+
+        # A slot left over from an earlier lap of the ring is cleared before reuse
+        if words[epochs + slot] != epoch:
+            counters[current:current + block] = self.zeros[:block]
+            words[epochs + slot] = epoch
+        live = [base + s * block for s in range(slots) if 0 <= (epoch - words[epochs + s]) & 0xFFFFFFFF < slots]
+        return current, live